@@ -0,0 +1,174 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from data_store import POLLUTANTS
+
+# Thresholds for each pollutant: a day whose mean is above it counts as an
+# exceedance
+THRESHOLDS = {
+    "BEN": 5,
+    "CO": 1,
+    "NO_2": 20,
+    "PM10": 20,
+    "PM25": 10,
+    "SO_2": 20,
+    "O_3": 60,
+}
+# Rolling mean windows in days, and the share of their days that must have a
+# value for the mean to be shown
+WINDOWS = [7, 30]
+MIN_COVERAGE = 0.5
+PERCENTILES = [50, 90, 98]
+
+
+# Statistics over the daily table, computed once at startup so each request
+# only looks results up:
+# - `exceedances[level]`: days above the threshold by station or area
+#   (NOM_TIPO) and year, one column per pollutant. An area counts the days on
+#   which any of its stations was above the threshold, each day once.
+# - `percentiles`: annual percentiles by station and year, columns
+#   (pollutant, percentile)
+# - `days`, `values[pollutant]` and `rolling[(pollutant, window)]`: the daily
+#   rows sorted by station and day, and `station_rows[station]` the slice of
+#   each station in them
+@dataclass(frozen=True)
+class Analytics:
+    exceedances: dict
+    percentiles: pd.DataFrame
+    days: np.ndarray
+    values: dict
+    rolling: dict
+    station_rows: dict
+
+
+# Mean of the values of each row's station over the `window` days ending on
+# that row's day, from cumulative sums over the sorted rows. `keys` orders
+# the rows and puts each station far enough from the next that a window
+# never reaches into another station. Missing days count as missing values.
+def rolling_mean(keys, values, window):
+    known = ~np.isnan(values)
+    sums = np.concatenate([[0.0], np.cumsum(np.where(known, values, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(known)])
+    first = np.searchsorted(keys, keys - (window - 1))
+    last = np.arange(1, len(keys) + 1)
+    count = counts[last] - counts[first]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (sums[last] - sums[first]) / count
+    return np.where(count >= MIN_COVERAGE * window, means, np.nan).astype(np.float32)
+
+
+# Percentiles of the values of each group (linear interpolation, like
+# numpy.percentile), from the values sorted by group and value: sorted by
+# value, then by group with a stable sort (much faster than a lexsort)
+def grouped_percentiles(groups, values, group_count, percentiles):
+    known = ~np.isnan(values)
+    groups, values = groups[known], values[known]
+    order = np.argsort(values)
+    order = order[np.argsort(groups[order], kind="stable")]
+    sorted_values = values[order]
+    sizes = np.bincount(groups, minlength=group_count)
+    starts = np.cumsum(sizes) - sizes
+    result = np.full((group_count, len(percentiles)), np.nan)
+    filled = sizes > 0
+    for column, percentile in enumerate(percentiles):
+        position = starts[filled] + percentile / 100 * (sizes[filled] - 1)
+        below = np.floor(position).astype(np.int64)
+        above = np.ceil(position).astype(np.int64)
+        result[filled, column] = sorted_values[below] + (
+            sorted_values[above] - sorted_values[below]
+        ) * (position - below)
+    return result
+
+
+def build(daily, stations):
+    codes = daily["station"].to_numpy()
+    days = daily["day"].to_numpy()
+    order = np.lexsort((days, codes))
+    codes, days = codes[order], days[order]
+    years = daily["year"].to_numpy()[order].astype(np.int64)
+
+    # Station of each sorted row as a position, and its slice of rows
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)]
+    station_codes = codes[starts]
+    station_index = np.repeat(np.arange(len(starts)), ends - starts)
+    station_rows = {code: slice(start, end) for code, start, end in zip(station_codes, starts, ends)}
+
+    # One group per station and year
+    first_year = int(years.min())
+    year_count = int(years.max()) - first_year + 1
+    groups = station_index * year_count + (years - first_year)
+    group_count = len(starts) * year_count
+    group_index = pd.MultiIndex.from_product(
+        [pd.Index(station_codes, name="station"), pd.RangeIndex(first_year, first_year + year_count, name="year")]
+    )
+
+    # Day numbers, spaced by station so rolling windows stay in one station
+    day_numbers = days.astype("datetime64[D]").astype(np.int64)
+    day_offsets = day_numbers - day_numbers.min()
+    span = int(day_offsets.max()) + max(WINDOWS) + 1
+    keys = station_index * span + day_offsets
+
+    # Area of each row as a position in the area categories (-1 for stations
+    # without one), one group per area and year, and one key per area and day
+    areas = stations["NOM_TIPO"].array
+    area_codes = areas.codes[stations.index.get_indexer(codes)].astype(np.int64)
+    in_area = area_codes >= 0
+    area_groups = area_codes * year_count + (years - first_year)
+    area_group_count = len(areas.categories) * year_count
+    area_days = area_codes * span + day_offsets
+    area_index = pd.MultiIndex.from_product(
+        [pd.Index(areas.categories, name="NOM_TIPO"), pd.RangeIndex(first_year, first_year + year_count, name="year")]
+    )
+
+    values = {}
+    rolling = {}
+    exceeded = {}
+    area_exceeded = {}
+    percentiles = {}
+    for pollutant in POLLUTANTS:
+        column = daily[pollutant].to_numpy()[order].astype(np.float64)
+        values[pollutant] = column.astype(np.float32)
+        for window in WINDOWS:
+            rolling[(pollutant, window)] = rolling_mean(keys, column, window)
+        with np.errstate(invalid="ignore"):
+            over = column > THRESHOLDS[pollutant]
+        exceeded[pollutant] = np.bincount(groups, weights=over, minlength=group_count).astype(np.int32)
+        measured = np.bincount(groups, weights=~np.isnan(column), minlength=group_count)
+        table = grouped_percentiles(groups, column, group_count, PERCENTILES)
+        for position, percentile in enumerate(PERCENTILES):
+            percentiles[(pollutant, percentile)] = table[:, position]
+        # Station-years without any measurement have no exceedance count
+        exceeded[pollutant] = np.where(measured > 0, exceeded[pollutant], -1)
+
+        # Days of each area above the threshold, each counted once however
+        # many of its stations were above it (the first row of every area and
+        # day gives its group)
+        selected = over & in_area
+        _, first = np.unique(area_days[selected], return_index=True)
+        counts = np.bincount(area_groups[selected][first], minlength=area_group_count)
+        area_measured = np.bincount(
+            area_groups[in_area], weights=~np.isnan(column[in_area]), minlength=area_group_count
+        )
+        area_exceeded[pollutant] = np.where(area_measured > 0, counts, -1).astype(np.int32)
+
+    by_station = pd.DataFrame(exceeded, index=group_index)
+    by_station = by_station.where(by_station >= 0).dropna(how="all")
+    # Areas where no station measured a pollutant that year have no count
+    by_area = pd.DataFrame(area_exceeded, index=area_index)
+    by_area = by_area.where(by_area >= 0).dropna(how="all")
+
+    percentile_table = pd.DataFrame(percentiles, index=group_index)
+    percentile_table.columns = pd.MultiIndex.from_tuples(percentile_table.columns, names=["pollutant", "percentile"])
+    percentile_table = percentile_table.dropna(how="all")
+
+    return Analytics(
+        exceedances={"station": by_station, "area": by_area},
+        percentiles=percentile_table,
+        days=days,
+        values=values,
+        rolling=rolling,
+        station_rows=station_rows,
+    )
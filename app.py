@@ -1,43 +1,39 @@
-from turtle import position
+import time
+
+# Start of the import of this file, reported against the budget at its end
+import_started = time.perf_counter()
+
+import itertools
+import os
+import threading
+
 import dash
+import diskcache
 from dash import dcc, html
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
-from prophet import Prophet
-import pandas as pd
-import matplotlib.pyplot as plt
-import unicodedata
-
-# Read and prepare the dataset
 
-station_data = pd.read_csv("avg_data_day.csv")
-station_data = station_data.dropna(subset=["lat", "lon"]).fillna(0)
+import analytics
+import data_store
+import downsampling
+import figure_cache
+import figure_encoding
+import forecasting
+import hourly_data
+import metrics
+import spatial
+import startup
 
-# Merge stations into areas of madrid
-metadata = pd.read_csv("informacion_estaciones_red_calidad_aire.csv", sep=";")
+# Only used to build figures, so imported on first use in fast startup mode
+px = startup.lazy_import("plotly.express")
 
-
-# Clean and normalize station names
-def clean_text(s):
-    if isinstance(s, str):
-        s = s.strip().lower()
-        s = unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("utf-8")
-        return s
-    return s
-
-
-# Clean and merge station names
-station_data["station_clean"] = station_data["name"].apply(clean_text)
-metadata["station_clean"] = metadata["ESTACION"].apply(clean_text)
-merged = station_data.merge(metadata, on="station_clean", how="left")
+# Read and prepare the dataset. The daily data, the station metadata and
+# the precomputed means the charts select from are all in the store.
+store = data_store.get()
+cube = store.cube
 
 # Aggregate data by station and month
-cig_aggregated_data = (
-    merged.groupby(["NOM_TIPO", "year"])
-    .agg({"Cigarettes": "mean"})
-    .reset_index()
-)
+cig_aggregated_data = cube["area_year"][["Cigarettes"]].reset_index()
 cig_aggregated_data = cig_aggregated_data.dropna(subset=["Cigarettes"])
 cig_aggregated_data = cig_aggregated_data[cig_aggregated_data["Cigarettes"] != 0]
 
@@ -45,13 +41,11 @@ cig_aggregated_data = cig_aggregated_data[cig_aggregated_data["Cigarettes"] != 0
 # Calculate the global maximum for Cigarette Equivalents
 global_max_value = cig_aggregated_data["Cigarettes"].max()
 
-pollutants = ["BEN", "CO", "NO_2", "SO_2", "O_3", "PM25", "PM10"]
+pollutants = data_store.POLLUTANTS
 
 # Group by year and calculate the average for each pollutant
-average_data_month = (
-    station_data.groupby(["year", "month"])[pollutants].mean().reset_index()
-)
-average_data = station_data.groupby("year")[pollutants].mean().reset_index()
+average_data_month = data_store.monthly_averages(cube)
+average_data = cube["year"][pollutants].reset_index()
 baseline_data = average_data[average_data["year"] == 2001]
 
 # Calculate percentage values relative to the baseline year
@@ -69,42 +63,353 @@ plot_data = average_data.melt(
 )
 
 # Thresholds for each pollutant
-pollutant_thresholds = {
-    "BEN": 5,
-    "CO": 1,
-    "NO_2": 20,
-    "PM10": 20,
-    "PM25": 10,
-    "SO_2": 20,
-    "O_3": 60,
-}
+pollutant_thresholds = analytics.THRESHOLDS
 
 # Find global min and max for Cigarettes
 global_x_min = cig_aggregated_data["Cigarettes"].min()
 global_x_max = cig_aggregated_data["Cigarettes"].max()
 
-# Initialize a dictionary to store forecasts for each pollutant
-forecasts = {}
+# Forecasts are fitted offline by forecasting.py and stored on disk; they are
+# only refitted here when the monthly data or the model parameters changed.
+# In fast startup mode that refit waits for the first forecast figure. The
+# engine (Prophet or the fast seasonal one) is set by FORECAST_MODEL.
+forecast_version = forecasting.forecast_key(average_data_month)
+# Forecasts of each station are only fitted offline, by
+# `python forecasting.py --stations`, and read when a station is selected
+station_forecast_version = forecasting.forecast_key(data_store.station_monthly_averages(cube))
+forecasts = None
+forecasts_lock = threading.Lock()
 
-# Generate forecasts for each pollutant using Prophet
-for pollutant in pollutants:
-    df = average_data_month[["year", "month", pollutant]].dropna()
-    df["ds"] = pd.to_datetime(df[["year", "month"]].assign(day=1))
-    df["y"] = df[pollutant]
-    df = df[["ds", "y"]]
-
-    from prophet import Prophet
-
-    model = Prophet(interval_width=0.95)
-    model.fit(df)
-    future = model.make_future_dataframe(periods=12 * (2030 - 2018), freq="ME")
-    forecast = model.predict(future)
-    forecast["observed"] = df["y"].reset_index(drop=True)  # Observed values
-    forecasts[pollutant] = forecast
-
-# Create the Dash app
-app = dash.Dash(__name__)
+
+def get_forecasts(progress=None):
+    global forecasts
+    with forecasts_lock:
+        if forecasts is None:
+            forecasts = forecasting.get_forecasts(average_data_month, progress=progress)
+    return forecasts
+
+
+if startup.FAST:
+    forecasts = forecasting.load_forecasts(forecast_version)
+else:
+    get_forecasts()
+
+# Exceedances, rolling means and percentiles over the daily table
+# (analytics.py), built once so requests only look them up. In fast startup
+# mode they are built on first use.
+stats = None
+stats_lock = threading.Lock()
+
+
+def get_stats():
+    global stats
+    with stats_lock:
+        if stats is None:
+            with metrics.startup_phase("analytics"):
+                stats = analytics.build(store.daily, store.stations)
+    return stats
+
+
+if not startup.FAST:
+    get_stats()
+
+# Cached figures are keyed by this, so they are rebuilt when the data changes
+data_version = data_store.data_version()
+
+# Slow callbacks run as Dash background callbacks: each request starts a job
+# process and the request worker only polls for its result, so it stays free
+# for other requests meanwhile. Results are kept in this disk cache, shared by
+# every worker, and reused for the same inputs and data.
+BACKGROUND_CACHE_DIR = os.environ.get("BACKGROUND_CACHE_DIR", "background_cache")
+background_manager = dash.DiskcacheManager(
+    diskcache.Cache(BACKGROUND_CACHE_DIR),
+    cache_by=[
+        lambda: data_version,
+        lambda: forecast_version,
+        lambda: forecasting.station_forecast_stamp(station_forecast_version),
+    ],
+    expire=24 * 60 * 60,
+)
+
+# Create the Dash app. Tab contents are only added to the layout when their
+# tab is opened, so their components are not in the initial layout.
+app = dash.Dash(
+    __name__,
+    suppress_callback_exceptions=True,
+    background_callback_manager=background_manager,
+)
 server = app.server  # for render
+metrics.instrument(app)
+
+
+years = cube["year"].index.tolist()
+cigarette_years = cig_aggregated_data["year"].unique().tolist()
+
+
+# Small views with a fixed set of inputs are sent to the browser once, as a
+# store holding the figure for every combination of inputs, and switched by a
+# clientside callback (assets/static_views.js) without a server round-trip.
+# The plotly template is the same in every figure, so it is only sent once.
+def static_view(store_id, build_figure, *options):
+    figures = {}
+    template = None
+    for inputs in itertools.product(*options):
+        figure = dict(build_figure(*inputs))
+        layout = dict(figure["layout"])
+        template = layout.pop("template", template)
+        figures["|".join(map(str, inputs))] = {**figure, "layout": layout}
+    return dcc.Store(id=store_id, data={"template": template, "figures": figures})
+
+
+# Year selector of the charts that show one year at a time
+def year_slider(slider_id):
+    return dcc.Slider(
+        id=slider_id,
+        min=years[0],
+        max=years[-1],
+        step=1,
+        value=years[0],
+        marks={year: str(year) for year in years},
+    )
+
+
+# Contents of each tab, built the first time the tab is selected
+def map_tab():
+    return html.Div(
+        [
+            html.Label("Select Pollutant:"),
+            dcc.Dropdown(
+                id="map-dropdown",
+                options=[
+                    {"label": pollutant, "value": pollutant}
+                    for pollutant in pollutants
+                ],
+                value="PM10",  # Default pollutant
+            ),
+            dcc.Graph(id="map-graph"),
+            year_slider("map-year-slider"),
+        ]
+    )
+
+
+def station_type_tab():
+    return html.Div(
+        [
+            html.Label("Select Pollutant:"),
+            dcc.Dropdown(
+                id="station-type-pollutant-dropdown",
+                options=[
+                    {"label": pollutant, "value": pollutant}
+                    for pollutant in pollutants
+                ],
+                value="BEN",
+            ),
+            dcc.Graph(id="station-type-bar-graph"),
+            year_slider("station-type-year-slider"),
+        ]
+    )
+
+
+def cigarette_tab():
+    return html.Div(
+        [
+            html.Label("Select Year:"),
+            dcc.Dropdown(
+                id="year-dropdown",
+                options=[
+                    {"label": str(year), "value": year}
+                    for year in cigarette_years
+                ],
+                value=cigarette_years[-1],  # Default: Last available year
+            ),
+            dcc.Graph(id="cigarette-graph"),
+            static_view("cigarette-figures", update_graph, cigarette_years),
+        ]
+    )
+
+
+def line_tab():
+    return html.Div(
+        [
+            html.Label("Select Pollutant:"),
+            dcc.Dropdown(
+                id="line-dropdown",
+                options=[{"label": "All", "value": "All"}]
+                + [
+                    {"label": pollutant, "value": pollutant}
+                    for pollutant in pollutants
+                ],
+                value="All",  # Default to "All"
+            ),
+            html.Label(r"Select Concentration or % change:"),
+            dcc.Dropdown(
+                id="view-dropdown",
+                options=[
+                    {
+                        "label": "Percentage Change",
+                        "value": "Percentage",
+                    },
+                    {
+                        "label": "Concentration (µg/m³)",
+                        "value": "Concentration",
+                    },
+                ],
+                value="Percentage",  # Default: Percentage view
+            ),
+            dcc.Graph(id="line-graph"),
+            static_view(
+                "line-figures",
+                update_line_chart,
+                ["All", *pollutants],
+                ["Percentage", "Concentration"],
+            ),
+        ]
+    )
+
+
+def seasonal_tab():
+    return html.Div(
+        [
+            html.Label("Select Pollutant:"),
+            dcc.Dropdown(
+                id="seasonal-dropdown",
+                options=[
+                    {"label": pollutant, "value": pollutant}
+                    for pollutant in pollutants
+                ],
+                value="PM10",  # Default pollutant
+            ),
+            dcc.Graph(id="seasonal-graph"),
+        ]
+    )
+
+
+def forecast_tab():
+    station_names = store.stations["name"].sort_values()
+    return html.Div(
+        [
+            html.Label("Select Pollutant:"),
+            dcc.Dropdown(
+                id="forecast-dropdown",
+                options=[
+                    {"label": pollutant, "value": pollutant}
+                    for pollutant in pollutants
+                ],
+                value="PM10",  # Default to "All"
+            ),
+            html.Label("Select Station:"),
+            dcc.Dropdown(
+                id="forecast-station-dropdown",
+                options=[{"label": "All stations (city-wide mean)", "value": "all"}]
+                + [{"label": name, "value": code} for code, name in station_names.items()],
+                value="all",
+                clearable=False,
+            ),
+            # Shown while the forecasts are fitted (fast startup mode)
+            html.Div(
+                [
+                    html.Progress(id="forecast-progress", value="0", max=str(len(pollutants))),
+                    html.Button("Cancel", id="forecast-cancel", disabled=True),
+                ],
+                id="forecast-status",
+                style={"visibility": "hidden"},
+            ),
+            dcc.Graph(id="forecast-graph"),
+        ]
+    )
+
+
+def daily_tab():
+    station_names = store.stations["name"].sort_values()
+    return html.Div(
+        [
+            html.Label("Select Station:"),
+            dcc.Dropdown(
+                id="daily-station-dropdown",
+                options=[
+                    {"label": name, "value": code}
+                    for code, name in station_names.items()
+                ],
+                value=station_names.index[0],
+            ),
+            html.Label("Select Pollutant:"),
+            dcc.Dropdown(
+                id="daily-pollutant-dropdown",
+                options=[
+                    {"label": pollutant, "value": pollutant}
+                    for pollutant in pollutants
+                ],
+                value="NO_2",
+            ),
+            dcc.RadioItems(
+                id="daily-method",
+                options=[
+                    {"label": "Line shape (LTTB)", "value": "lttb"},
+                    {"label": "Daily extremes (min/max)", "value": "min_max"},
+                ],
+                value="lttb",
+                inline=True,
+            ),
+            dcc.Graph(id="daily-graph"),
+            # Width of the graph and visible date range, from the browser
+            dcc.Store(id="daily-view", data={"width": DAILY_DEFAULT_WIDTH, "range": None}),
+        ]
+        # Hourly profile of the dates in view, when the hourly dataset was
+        # written (data_prep_day.py --hourly)
+        + ([dcc.Graph(id="diurnal-graph")] if hourly_data.available() else [])
+    )
+
+
+def exceedance_tab():
+    station_names = store.stations["name"].sort_values()
+    return html.Div(
+        [
+            html.Label("Select Pollutant:"),
+            dcc.Dropdown(
+                id="exceedance-pollutant-dropdown",
+                options=[
+                    {"label": pollutant, "value": pollutant}
+                    for pollutant in pollutants
+                ],
+                value="NO_2",
+            ),
+            dcc.RadioItems(
+                id="exceedance-level",
+                options=[
+                    {"label": "By station", "value": "station"},
+                    {"label": "By area", "value": "area"},
+                ],
+                value="station",
+                inline=True,
+            ),
+            dcc.Graph(id="exceedance-graph"),
+            html.Label("Select Station:"),
+            dcc.Dropdown(
+                id="exceedance-station-dropdown",
+                options=[
+                    {"label": name, "value": code}
+                    for code, name in station_names.items()
+                ],
+                value=station_names.index[0],
+            ),
+            dcc.Graph(id="rolling-graph"),
+            dcc.Graph(id="percentile-graph"),
+        ]
+    )
+
+
+# Tabs in display order: value, label and the function building the contents
+tabs = [
+    ("map", "Map of Madrid", map_tab),
+    ("station-type", "Pollutants in Area's of Madrid", station_type_tab),
+    ("cigarettes", "Cig chart of Pollutants", cigarette_tab),
+    ("line", "Line Chart of Pollutants", line_tab),
+    ("seasonal", "Seasonal Pollution Patterns", seasonal_tab),
+    ("forecast", "Forecast chart of Pollutants", forecast_tab),
+    ("daily", "Daily Pollution by Station", daily_tab),
+    ("exceedances", "Threshold Exceedances", exceedance_tab),
+]
+tab_contents = {value: build for value, label, build in tabs}
 
 # App layout
 app.layout = html.Div(
@@ -139,195 +444,176 @@ app.layout = html.Div(
             },
         ),
         dcc.Tabs(
-            [
-                dcc.Tab(
-                    label="Map of Madrid",
-                    children=[
-                        html.Div(
-                            [
-                                html.Label("Select Pollutant:"),
-                                dcc.Dropdown(
-                                    id="map-dropdown",
-                                    options=[
-                                        {"label": pollutant, "value": pollutant}
-                                        for pollutant in pollutants
-                                    ],
-                                    value="PM10",  # Default pollutant
-                                ),
-                                dcc.Graph(id="map-graph"),
-                            ]
-                        )
-                    ],
-                ), 
-                dcc.Tab(
-                    label="Pollutants in Area's of Madrid",
-                    children=[
-                        html.Div(
-                            [
-                                html.Label("Select Pollutant:"),
-                                dcc.Dropdown(
-                                    id="station-type-pollutant-dropdown",
-                                    options=[
-                                        {"label": pollutant, "value": pollutant}
-                                        for pollutant in pollutants
-                                        if pollutant
-                                        not in [
-                                            "CO",
-                                            "PM10",
-                                        ]  # Exclude CO and PM10 bcs it was giving errors.
-                                    ],
-                                    value="BEN",
-                                ),
-                                dcc.Graph(id="station-type-bar-graph"),
-                            ]
-                        )
-                    ],
-                ),
-                
-                dcc.Tab(
-                    label="Cig chart of Pollutants",
-                    children=[
-                        html.Div(
-                            [
-                                html.Label("Select Year:"),
-                                dcc.Dropdown(
-                                    id="year-dropdown",
-                                    options=[
-                                        {"label": str(year), "value": year}
-                                        for year in cig_aggregated_data["year"].unique()
-                                    ],
-                                    value=cig_aggregated_data["year"].unique()[
-                                        -1
-                                    ],  # Default: Last available year
-                                ),
-                                dcc.Graph(id="cigarette-graph"),
-                            ]
-                        )
-                    ],
-                ),
+            id="tabs",
+            value=tabs[0][0],
+            children=[
                 dcc.Tab(
-                    label="Line Chart of Pollutants",
-                    children=[
-                        html.Div(
-                            [
-                                html.Label("Select Pollutant:"),
-                                dcc.Dropdown(
-                                    id="line-dropdown",
-                                    options=[{"label": "All", "value": "All"}]
-                                    + [
-                                        {"label": pollutant, "value": pollutant}
-                                        for pollutant in pollutants
-                                    ],
-                                    value="All",  # Default to "All"
-                                ),
-                                html.Label(r"Select Concentration or % change:"),
-                                dcc.Dropdown(
-                                    id="view-dropdown",
-                                    options=[
-                                        {
-                                            "label": "Percentage Change",
-                                            "value": "Percentage",
-                                        },
-                                        {
-                                            "label": "Concentration (µg/m³)",
-                                            "value": "Concentration",
-                                        },
-                                    ],
-                                    value="Percentage",  # Default: Percentage view
-                                ),
-                                dcc.Graph(id="line-graph"),
-                            ]
-                        )
-                    ],
-                ),
-                dcc.Tab(
-                    label="Seasonal Pollution Patterns",
-                    children=[
-                        html.Div(
-                            [
-                                html.Label("Select Pollutant:"),
-                                dcc.Dropdown(
-                                    id="seasonal-dropdown",
-                                    options=[
-                                        {"label": pollutant, "value": pollutant}
-                                        for pollutant in pollutants
-                                    ],
-                                    value="PM10",  # Default pollutant
-                                ),
-                                dcc.Graph(id="seasonal-graph"),
-                            ]
-                        )
-                    ],
-                ),
-                dcc.Tab(
-                    label="Forecast chart of Pollutants",
-                    children=[
-                        html.Div(
-                            [
-                                html.Label("Select Pollutant:"),
-                                dcc.Dropdown(
-                                    id="forecast-dropdown",
-                                    options=[
-                                        {"label": pollutant, "value": pollutant}
-                                        for pollutant in pollutants
-                                    ],
-                                    value="PM10",  # Default to "All"
-                                ),
-                                dcc.Graph(id="forecast-graph"),
-                            ]
-                        )
-                    ],
-                ),
-            ]
+                    label=label,
+                    value=value,
+                    children=[html.Div(id={"type": "tab-body", "index": value})],
+                )
+                for value, label, build in tabs
+            ],
         ),
     ]
 )
 
 
-# Callback to update the map based on dropdown selection
+# Fill the selected tab the first time it is opened. Tabs opened before keep
+# their contents, and so their figures, for the rest of the session.
+@app.callback(
+    dash.dependencies.Output({"type": "tab-body", "index": dash.ALL}, "children"),
+    [dash.dependencies.Input("tabs", "value")],
+    [
+        dash.dependencies.State({"type": "tab-body", "index": dash.ALL}, "children"),
+        dash.dependencies.State({"type": "tab-body", "index": dash.ALL}, "id"),
+    ],
+)
+def render_tab(selected_tab, bodies, body_ids):
+    return [
+        tab_contents[body_id["index"]]()
+        if body_id["index"] == selected_tab and not body
+        else dash.no_update
+        for body, body_id in zip(bodies, body_ids)
+    ]
+
+
+# Views switched in the browser from their static_view store
+for graph_id, input_ids, store_id in [
+    ("line-graph", ["line-dropdown", "view-dropdown"], "line-figures"),
+    ("cigarette-graph", ["year-dropdown"], "cigarette-figures"),
+]:
+    app.clientside_callback(
+        dash.ClientsideFunction(namespace="static_views", function_name="select"),
+        dash.dependencies.Output(graph_id, "figure"),
+        [dash.dependencies.Input(input_id, "value") for input_id in input_ids],
+        dash.dependencies.State(store_id, "data"),
+    )
+
+
+# Callback to update the map based on dropdown selection. The figure only
+# holds the selected year; moving the year slider sends just the new marker
+# values instead of a new figure.
 @app.callback(
     dash.dependencies.Output("map-graph", "figure"),
-    [dash.dependencies.Input("map-dropdown", "value")],
+    [
+        dash.dependencies.Input("map-dropdown", "value"),
+        dash.dependencies.Input("map-year-slider", "value"),
+    ],
 )
-def update_map(selected_pollutant):
-    aggregated_data = (
-        station_data.groupby(["name", "lat", "lon", "year"])
-        .agg({selected_pollutant: "mean"})
+def update_map(selected_pollutant, selected_year):
+    if dash.ctx.triggered_id != "map-year-slider":
+        return map_figure(selected_pollutant, selected_year)
+
+    year_data = map_year_data(selected_pollutant, selected_year)
+    patch = dash.Patch()
+    values = figure_encoding.encode_array(year_data[selected_pollutant].to_numpy())
+    patch["data"][0]["lat"] = figure_encoding.encode_array(year_data["lat"].to_numpy())
+    patch["data"][0]["lon"] = figure_encoding.encode_array(year_data["lon"].to_numpy())
+    patch["data"][0]["hovertext"] = year_data["name"]
+    patch["data"][0]["marker"]["color"] = values
+    patch["data"][0]["marker"]["size"] = values
+    patch["layout"]["title"]["text"] = map_title(selected_pollutant, selected_year)
+    if map_grid is not None:
+        patch["layout"]["map"]["layers"][0]["source"] = map_surface(selected_pollutant, selected_year)["source"]
+    return patch
+
+
+def map_year_data(selected_pollutant, selected_year):
+    return (
+        cube["station_year"][selected_pollutant]
+        .xs(selected_year, level="year")
         .reset_index()
     )
 
-    min_val = aggregated_data[selected_pollutant].min()
-    max_val = aggregated_data[selected_pollutant].max()
+
+def map_title(selected_pollutant, selected_year):
+    return f"Pollution Levels by Station ({selected_pollutant}, {selected_year})"
+
+
+map_colorscale = [
+    (0.0, "#3B4CC0"),  # Low values are dark blue
+    (0.5, "#F4A259"),  # Medium values are orange
+    (1.0, "#D7263D"),  # High values are dark red
+]
+
+# Surface interpolated between the stations (spatial.py), drawn under the
+# markers as an image layer. MAP_GRID_SIZE=0 turns it off.
+located_stations = store.stations.dropna(subset=["lat", "lon"])
+map_grid = (
+    spatial.build_grid(located_stations["lat"], located_stations["lon"])
+    if spatial.GRID_SIZE
+    else None
+)
+# Key of the frames, and of the map figures drawing them
+map_version = (data_version, spatial.settings(), figure_cache.source_hash(spatial.raster_frame))
+
+
+# One small PNG frame per pollutant and year, on the color scale of the
+# markers, cached like the figures so moving the slider only sends a frame.
+# Only the stations measuring the pollutant that year are interpolated (the
+# others are NaN, not 0), and the colors span the measured means.
+@figure_cache.cached_value("map_surface", map_version)
+def map_surface(selected_pollutant, selected_year):
+    aggregated_data = cube["station_year_measured"][selected_pollutant]
+    values = (
+        aggregated_data.xs(selected_year, level="year")
+        .reindex(located_stations.index)
+    )
+    return spatial.raster_frame(
+        map_grid,
+        values.to_numpy(),
+        aggregated_data.min(),
+        aggregated_data.max(),
+        map_colorscale,
+    )
+
+
+@figure_cache.cached_figure("update_map", map_version)
+def map_figure(selected_pollutant, selected_year):
+    aggregated_data = cube["station_year"][selected_pollutant]
+
+    # Colors and marker sizes are scaled against every year, so the years
+    # can be compared while moving the slider
+    min_val = aggregated_data.min()
+    max_val = aggregated_data.max()
 
     fig = px.scatter_map(
-        aggregated_data,
+        map_year_data(selected_pollutant, selected_year),
         lat="lat",
         lon="lon",
         color=selected_pollutant,
         size=selected_pollutant,
         hover_name="name",
-        animation_frame="year",
-        title=f"Pollution Levels by Station ({selected_pollutant})",
-        color_continuous_scale=[
-            (0.0, "#3B4CC0"),  # Low values are dark blue
-            (0.5, "#F4A259"),  # Medium values are orange
-            (1.0, "#D7263D"),  # High values are dark red
-        ],
+        title=map_title(selected_pollutant, selected_year),
+        color_continuous_scale=map_colorscale,
         range_color=(min_val, max_val),  # Adjust range to fit pollutant levels
         map_style="carto-positron"
     )
-    fig.update_layout(height=600)
+    fig.update_traces(marker_sizeref=2.0 * max_val / 20**2)
+    if map_grid is not None:
+        surface = map_surface(selected_pollutant, selected_year)
+        fig.update_layout(
+            map_layers=[
+                dict(
+                    sourcetype="image",
+                    source=surface["source"],
+                    coordinates=surface["coordinates"],
+                    opacity=0.6,
+                    below="traces",
+                )
+            ]
+        )
+    fig.update_layout(
+        height=600,
+        map_center=dict(lat=store.stations["lat"].mean(), lon=store.stations["lon"].mean()),
+    )
     return fig
 
 
-# Callback to update the line chart based on dropdown selection
-@app.callback(
-    dash.dependencies.Output("line-graph", "figure"),
-    [
-        dash.dependencies.Input("line-dropdown", "value"),
-        dash.dependencies.Input("view-dropdown", "value"),
-    ],
-)
+# The line chart is switched in the browser (see static_view below); every
+# pollutant and view is built here once
+@figure_cache.cached_figure("update_line_chart", data_version)
 def update_line_chart(selected_pollutant, selected_view):
     color_map = dict(zip(plot_data["Pollutant"].unique(), px.colors.qualitative.Safe))
     if selected_view == "Percentage":
@@ -416,12 +702,69 @@ def update_line_chart(selected_pollutant, selected_view):
     return fig
 
 
+# City-wide forecast, or the stored one of the selected station. Stations
+# whose forecast is not stored (never fitted, not enough data, or the fit
+# failed) get a message instead, kept only until a station forecast is
+# stored (the last key of cache_by). Runs in the background: when the
+# city-wide forecasts are not stored yet they are fitted here, reporting
+# each pollutant done, and the fit can be cancelled.
 @app.callback(
     dash.dependencies.Output("forecast-graph", "figure"),
-    [dash.dependencies.Input("forecast-dropdown", "value")],
+    [
+        dash.dependencies.Input("forecast-dropdown", "value"),
+        dash.dependencies.Input("forecast-station-dropdown", "value"),
+    ],
+    background=True,
+    progress=[
+        dash.dependencies.Output("forecast-progress", "value"),
+        dash.dependencies.Output("forecast-progress", "max"),
+    ],
+    running=[
+        (dash.dependencies.Output("forecast-status", "style"), {"visibility": "visible"}, {"visibility": "hidden"}),
+        (dash.dependencies.Output("forecast-cancel", "disabled"), False, True),
+    ],
+    cancel=[dash.dependencies.Input("forecast-cancel", "n_clicks")],
+    interval=500,
 )
-def update_forecast(selected_pollutant):
-    forecast = forecasts[selected_pollutant]
+def update_forecast(set_progress, selected_pollutant, selected_station):
+    if selected_station != "all":
+        forecast, reason = forecasting.load_station_forecast(
+            station_forecast_version, selected_station, selected_pollutant
+        )
+        if forecast is None:
+            figure = missing_forecast_figure(selected_pollutant, selected_station, reason)
+            return figure_encoding.encode_figure(figure.to_dict())
+    else:
+        get_forecasts(progress=lambda done, total: set_progress((str(done), str(total))))
+    return forecast_figure(selected_pollutant, selected_station)
+
+
+def missing_forecast_figure(selected_pollutant, selected_station, reason):
+    fig = go.Figure()
+    fig.add_annotation(
+        text=f"No {selected_pollutant} forecast for {store.stations['name'][selected_station]}: {reason}",
+        showarrow=False,
+        font=dict(size=16),
+    )
+    fig.update_layout(
+        height=600,
+        plot_bgcolor="white",
+        xaxis=dict(visible=False),
+        yaxis=dict(visible=False),
+    )
+    return fig
+
+
+# Keyed by the forecasts rather than the daily data, so switching the engine
+# rebuilds the figure
+@figure_cache.cached_figure("update_forecast", (forecast_version, station_forecast_version))
+def forecast_figure(selected_pollutant, selected_station):
+    if selected_station == "all":
+        forecast = get_forecasts()[selected_pollutant]
+    else:
+        forecast, _ = forecasting.load_station_forecast(
+            station_forecast_version, selected_station, selected_pollutant
+        )
 
     # Get the year when the observed data ends (e.g., 2018)
     cutoff_year = 2018
@@ -539,12 +882,8 @@ def update_forecast(selected_pollutant):
     return fig
 
 
-@app.callback(
-    dash.dependencies.Output("cigarette-graph", "figure"),
-    [
-        dash.dependencies.Input("year-dropdown", "value")
-    ],
-)
+# Switched in the browser like the line chart
+@figure_cache.cached_figure("update_graph", data_version)
 def update_graph(selected_year):
     cig_year = cig_aggregated_data[cig_aggregated_data["year"] == selected_year]
     x_coords = cig_year["year"]  # Year for x-axis
@@ -607,11 +946,10 @@ def update_graph(selected_year):
     dash.dependencies.Output("seasonal-graph", "figure"),
     [dash.dependencies.Input("seasonal-dropdown", "value")],
 )
+@figure_cache.cached_figure("update_seasonal_chart", data_version)
 def update_seasonal_chart(selected_pollutant):
-    # Group data by year and month, then compute the monthly average
-    seasonal_data = (
-        station_data.groupby(["year", "month"])[selected_pollutant].mean().reset_index()
-    )
+    # Monthly average of the pollutant for every year
+    seasonal_data = cube["year_month"][[selected_pollutant]].reset_index()
 
     min_val = seasonal_data[selected_pollutant].min()
     max_val = seasonal_data[selected_pollutant].max()
@@ -662,16 +1000,40 @@ def update_seasonal_chart(selected_pollutant):
     return fig
 
 
+# The bar chart shows one year at a time like the map; the year slider only
+# sends the new bar heights
 @app.callback(
     dash.dependencies.Output("station-type-bar-graph", "figure"),
-    [dash.dependencies.Input("station-type-pollutant-dropdown", "value")],
+    [
+        dash.dependencies.Input("station-type-pollutant-dropdown", "value"),
+        dash.dependencies.Input("station-type-year-slider", "value"),
+    ],
 )
-def update_station_type_bar_chart(selected_pollutant):
-    merged[selected_pollutant] = pd.to_numeric(
-        merged[selected_pollutant], errors="coerce"
+def update_station_type_bar_chart(selected_pollutant, selected_year):
+    if dash.ctx.triggered_id != "station-type-year-slider":
+        return station_type_bar_figure(selected_pollutant, selected_year)
+
+    by_area = cube["area_year"][selected_pollutant].unstack("NOM_TIPO")
+    patch = dash.Patch()
+    for i, value in enumerate(by_area.loc[selected_year]):
+        patch["data"][i]["y"] = [value]
+    patch["layout"]["title"]["text"] = station_type_title(selected_pollutant, selected_year)
+    return patch
+
+
+def station_type_title(selected_pollutant, selected_year):
+    return f"Average {selected_pollutant} Concentration in Madrid ({selected_year})"
+
+
+@figure_cache.cached_figure("update_station_type_bar_chart", data_version)
+def station_type_bar_figure(selected_pollutant, selected_year):
+    # One column per area, so every area has a bar (and a trace to patch) in
+    # every year
+    by_area = cube["area_year"][selected_pollutant].unstack("NOM_TIPO")
+    areas = by_area.columns.astype(str).tolist()
+    grouped = pd.DataFrame(
+        {"NOM_TIPO": areas, selected_pollutant: by_area.loc[selected_year].to_numpy()}
     )
-    # Added grouping by year
-    grouped = merged.groupby(["NOM_TIPO", "year"])[selected_pollutant].mean().reset_index()    
 
     # I wanted red to be assigned to traffiic bar:
     custom_safe_colors = ["#88CCEE", "#DDCC77", "#CC6677"]  # blue, yellow, red
@@ -680,14 +1042,14 @@ def update_station_type_bar_chart(selected_pollutant):
         grouped,
         x="NOM_TIPO",
         y=selected_pollutant,
-        title=f"Average {selected_pollutant} Concentration in Madrid (2001-2018)",
+        title=station_type_title(selected_pollutant, selected_year),
         labels={
             "NOM_TIPO": "Area in madrid",
             selected_pollutant: f"Average {selected_pollutant} (µg/m³)",
         },
         color="NOM_TIPO",
         color_discrete_sequence=custom_safe_colors,
-        animation_frame="year"
+        category_orders={"NOM_TIPO": areas},
     )
 
     fig.update_layout(
@@ -699,12 +1061,299 @@ def update_station_type_bar_chart(selected_pollutant):
                 size=14,
             ),
         ),
+        # Same scale for every year
+        yaxis=dict(range=[0, by_area.max().max() * 1.05]),
     )
     fig.update_layout(transition_duration=500)
 
     return fig
 
 
+# Empty chart with a message, for a station and pollutant without data
+def no_data_figure(message, height):
+    fig = go.Figure()
+    fig.add_annotation(text=message, showarrow=False, font=dict(size=16))
+    fig.update_layout(
+        height=height,
+        plot_bgcolor="white",
+        xaxis=dict(visible=False),
+        yaxis=dict(visible=False),
+    )
+    return fig
+
+
+# The daily series are downsampled to about one point per pixel of the graph
+# (measured in the browser by assets/daily_view.js) over the visible date
+# range, so zooming in brings back the detail of the days in view
+DAILY_DEFAULT_WIDTH = 1000
+
+
+# Days and values of a station, sorted by day, without the missing ones
+def daily_series(station, pollutant):
+    results = get_stats()
+    rows = results.station_rows[station]
+    days = results.days[rows]
+    values = results.values[pollutant][rows]
+    known = ~pd.isna(values)
+    return days[known], values[known]
+
+
+def daily_figure(station, pollutant, method, view):
+    days, values = daily_series(station, pollutant)
+    total = len(days)
+    if not total:
+        return no_data_figure(f"{store.stations['name'][station]} has no {pollutant} measurements", 600)
+
+    # Only the days in view (and one beyond each side, so the line reaches
+    # the edges) are downsampled
+    start, end = 0, total
+    if view["range"]:
+        first, last = (pd.Timestamp(bound).to_datetime64() for bound in view["range"])
+        start = max(days.searchsorted(first) - 1, 0)
+        end = min(days.searchsorted(last, side="right") + 1, total)
+    days, values = days[start:end], values[start:end]
+
+    width = max(int(view["width"] or DAILY_DEFAULT_WIDTH), 10)
+    if method == "min_max":
+        kept = downsampling.min_max(values, width // 2)
+    else:
+        kept = downsampling.lttb(days.astype("int64"), values, width)
+
+    fig = go.Figure(
+        go.Scatter(
+            x=days[kept],
+            y=values[kept],
+            mode="lines",
+            line=dict(color="rgb(136, 204, 238)", width=1.5),
+            name=pollutant,
+        )
+    )
+    fig.add_hline(
+        y=pollutant_thresholds[pollutant],
+        line=dict(color="rgb(204, 102, 119)", dash="dash", width=2),
+    )
+    fig.update_layout(
+        title=(
+            f"Daily {pollutant} at {store.stations['name'][station]} "
+            f"({len(kept)} of {total} days shown)"
+        ),
+        height=600,
+        plot_bgcolor="white",
+        showlegend=False,
+        xaxis=dict(title="Date", showgrid=False),
+        yaxis=dict(title=f"{pollutant} Concentration (µg/m³)", showgrid=False),
+        # Keep the zoom of the user while the detail is refined
+        uirevision=f"{station}|{pollutant}",
+    )
+    if view["range"]:
+        fig.update_xaxes(range=view["range"])
+    return fig
+
+
+# Figures depend on the zoom, so they are not cached: downsampling a station
+# takes a few milliseconds
+@app.callback(
+    dash.dependencies.Output("daily-graph", "figure"),
+    [
+        dash.dependencies.Input("daily-station-dropdown", "value"),
+        dash.dependencies.Input("daily-pollutant-dropdown", "value"),
+        dash.dependencies.Input("daily-method", "value"),
+        dash.dependencies.Input("daily-view", "data"),
+    ],
+)
+def update_daily_chart(station, pollutant, method, view):
+    if station is None or pollutant is None:
+        return dash.no_update
+    return figure_encoding.encode_figure(daily_figure(station, pollutant, method, view).to_dict())
+
+
+# Mean of each hour of the day over the dates in view. Only the station,
+# pollutant and years (and row groups) in range are read from the hourly
+# dataset.
+def update_diurnal_chart(station, pollutant, view):
+    if station is None or pollutant is None:
+        return dash.no_update
+    start, end = view["range"] or (None, None)
+    cycle = hourly_data.diurnal_cycle(start, end, [station], [pollutant])
+    if cycle[pollutant].isna().all():
+        fig = no_data_figure(f"{store.stations['name'][station]} has no hourly {pollutant} measurements", 400)
+        return figure_encoding.encode_figure(fig.to_dict())
+
+    fig = go.Figure(
+        go.Scatter(
+            x=cycle.index,
+            y=cycle[pollutant],
+            mode="lines+markers",
+            line=dict(color="rgb(136, 204, 238)", width=3),
+        )
+    )
+    period = f"{start[:10]} to {end[:10]}" if view["range"] else "2001-2018"
+    fig.update_layout(
+        title=f"Average {pollutant} by Hour of the Day at {store.stations['name'][station]} ({period})",
+        height=400,
+        plot_bgcolor="white",
+        xaxis=dict(title="Hour", dtick=2, showgrid=False),
+        yaxis=dict(title=f"{pollutant} Concentration (µg/m³)", showgrid=False),
+    )
+    return figure_encoding.encode_figure(fig.to_dict())
+
+
+if hourly_data.available():
+    app.callback(
+        dash.dependencies.Output("diurnal-graph", "figure"),
+        [
+            dash.dependencies.Input("daily-station-dropdown", "value"),
+            dash.dependencies.Input("daily-pollutant-dropdown", "value"),
+            dash.dependencies.Input("daily-view", "data"),
+        ],
+    )(update_diurnal_chart)
+
+
+app.clientside_callback(
+    dash.ClientsideFunction(namespace="daily_view", function_name="viewport"),
+    dash.dependencies.Output("daily-view", "data"),
+    dash.dependencies.Input("daily-graph", "relayoutData"),
+    dash.dependencies.State("daily-view", "data"),
+)
+
+
+# Days above the threshold in every year, one row per station or area (the
+# days on which any of its stations was above it)
+@app.callback(
+    dash.dependencies.Output("exceedance-graph", "figure"),
+    [
+        dash.dependencies.Input("exceedance-pollutant-dropdown", "value"),
+        dash.dependencies.Input("exceedance-level", "value"),
+    ],
+)
+@figure_cache.cached_figure("update_exceedance_chart", data_version)
+def update_exceedance_chart(selected_pollutant, selected_level):
+    table = get_stats().exceedances[selected_level][selected_pollutant].unstack("year")
+    if selected_level == "station":
+        table.index = store.stations["name"].reindex(table.index)
+    table = table.sort_index()
+
+    fig = go.Figure(
+        go.Heatmap(
+            z=table.to_numpy(),
+            x=table.columns,
+            y=table.index,
+            colorscale="Reds",
+            colorbar=dict(title="Days"),
+            hovertemplate="%{y}, %{x}: %{z} days<extra></extra>",
+        )
+    )
+    fig.update_layout(
+        title=(
+            f"Days with {selected_pollutant} above "
+            f"{pollutant_thresholds[selected_pollutant]} µg/m³"
+        ),
+        height=max(300, 40 * len(table) + 150),
+        plot_bgcolor="white",
+        xaxis=dict(title="Year", dtick=1),
+        yaxis=dict(title="", autorange="reversed"),
+    )
+    return fig
+
+
+# Daily values of a station with their 7- and 30-day rolling means, each
+# downsampled to the default width of the daily chart
+@app.callback(
+    dash.dependencies.Output("rolling-graph", "figure"),
+    [
+        dash.dependencies.Input("exceedance-station-dropdown", "value"),
+        dash.dependencies.Input("exceedance-pollutant-dropdown", "value"),
+    ],
+)
+@figure_cache.cached_figure("update_rolling_chart", data_version)
+def update_rolling_chart(station, selected_pollutant):
+    results = get_stats()
+    rows = results.station_rows[station]
+    days = results.days[rows]
+    if pd.isna(results.values[selected_pollutant][rows]).all():
+        return no_data_figure(
+            f"{store.stations['name'][station]} has no {selected_pollutant} measurements", 500
+        )
+    series = [
+        ("Daily", results.values[selected_pollutant][rows], "rgb(200, 200, 200)", 1),
+        *(
+            (f"{window}-day mean", results.rolling[(selected_pollutant, window)][rows], color, 2)
+            for window, color in zip(analytics.WINDOWS, ["rgb(136, 204, 238)", "rgb(68, 119, 170)"])
+        ),
+    ]
+
+    fig = go.Figure()
+    for name, values, color, width in series:
+        known = ~pd.isna(values)
+        x, y = days[known], values[known]
+        kept = downsampling.lttb(x.astype("int64"), y, DAILY_DEFAULT_WIDTH)
+        fig.add_trace(
+            go.Scatter(x=x[kept], y=y[kept], mode="lines", name=name, line=dict(color=color, width=width))
+        )
+    fig.add_hline(
+        y=pollutant_thresholds[selected_pollutant],
+        line=dict(color="rgb(204, 102, 119)", dash="dash", width=2),
+    )
+    fig.update_layout(
+        title=f"Rolling Means of {selected_pollutant} at {store.stations['name'][station]}",
+        height=500,
+        plot_bgcolor="white",
+        xaxis=dict(title="Date", showgrid=False),
+        yaxis=dict(title=f"{selected_pollutant} Concentration (µg/m³)", showgrid=False),
+    )
+    return fig
+
+
+# Annual percentiles of the daily values of a station
+@app.callback(
+    dash.dependencies.Output("percentile-graph", "figure"),
+    [
+        dash.dependencies.Input("exceedance-station-dropdown", "value"),
+        dash.dependencies.Input("exceedance-pollutant-dropdown", "value"),
+    ],
+)
+@figure_cache.cached_figure("update_percentile_chart", data_version)
+def update_percentile_chart(station, selected_pollutant):
+    percentiles = get_stats().percentiles
+    table = (
+        percentiles.loc[percentiles.index.get_level_values("station") == station, selected_pollutant]
+        .droplevel("station")
+        .dropna(how="all")
+    )
+    if table.empty:
+        return no_data_figure(
+            f"{store.stations['name'][station]} has no {selected_pollutant} measurements", 400
+        )
+
+    fig = go.Figure()
+    for percentile, color in zip(
+        analytics.PERCENTILES, ["rgb(136, 204, 238)", "rgb(68, 119, 170)", "rgb(51, 34, 136)"]
+    ):
+        fig.add_trace(
+            go.Scatter(
+                x=table.index,
+                y=table[percentile],
+                mode="lines+markers",
+                name=f"P{percentile}",
+                line=dict(color=color, width=3),
+            )
+        )
+    fig.add_hline(
+        y=pollutant_thresholds[selected_pollutant],
+        line=dict(color="rgb(204, 102, 119)", dash="dash", width=2),
+    )
+    fig.update_layout(
+        title=f"Annual Percentiles of Daily {selected_pollutant} at {store.stations['name'][station]}",
+        height=400,
+        plot_bgcolor="white",
+        xaxis=dict(title="Year", dtick=1, showgrid=False),
+        yaxis=dict(title=f"{selected_pollutant} Concentration (µg/m³)", showgrid=False),
+    )
+    return fig
+
+
+startup.report_import(import_started)
+
 # Run the app
 if __name__ == "__main__":
     app.run(debug=False)
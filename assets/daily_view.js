@@ -0,0 +1,25 @@
+// Clientside callback of the daily tab in app.py: keeps the width of the
+// daily graph and its visible date range in the "daily-view" store, which
+// the server downsamples the series to.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    daily_view: {
+        viewport: function (relayoutData, view) {
+            const graph = document.getElementById("daily-graph");
+            const width = graph ? graph.offsetWidth : view.width;
+            let range = view.range;
+            if (relayoutData) {
+                if ("xaxis.range[0]" in relayoutData) {
+                    range = [relayoutData["xaxis.range[0]"], relayoutData["xaxis.range[1]"]];
+                } else if ("xaxis.range" in relayoutData) {
+                    range = relayoutData["xaxis.range"];
+                } else if (relayoutData["xaxis.autorange"]) {
+                    range = null;
+                }
+            }
+            if (width === view.width && JSON.stringify(range) === JSON.stringify(view.range)) {
+                return window.dash_clientside.no_update;
+            }
+            return {width: width, range: range};
+        },
+    },
+});
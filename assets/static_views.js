@@ -0,0 +1,17 @@
+// Clientside callbacks of the views registered with static_view() in app.py.
+// The store holds one prebuilt figure per combination of inputs, keyed by the
+// input values joined with "|", and the plotly template shared by all of them.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    static_views: {
+        select: function (...args) {
+            const view = args.pop();
+            const figure = view && view.figures[args.join("|")];
+            if (!figure) {
+                return window.dash_clientside.no_update;
+            }
+            return Object.assign({}, figure, {
+                layout: Object.assign({template: view.template}, figure.layout),
+            });
+        },
+    },
+});
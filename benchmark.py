@@ -0,0 +1,349 @@
+import argparse
+import datetime
+import gc
+import itertools
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Benchmarks are run one case per process, so each one starts from a fresh
+# interpreter and its memory peak is its own
+CASES = ["prep", "startup", "import", "callbacks"]
+
+RESULTS_DIR = "benchmarks"
+BASELINE_FILE = os.path.join(RESULTS_DIR, "baseline.json")
+LATEST_FILE = os.path.join(RESULTS_DIR, "latest.json")
+
+# Relative increase over the baseline reported as a regression, by unit.
+# Timings below NOISE_SECONDS are too short to compare.
+TOLERANCE = {"seconds": 0.25, "bytes": 0.10}
+NOISE_SECONDS = 0.005
+
+
+# Peak of the Python allocations of one run of func. tracemalloc slows the
+# run down several times, so it is kept out of the timed runs.
+def memory_peak(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Time func over `repeat` runs, then (with `peak`) run it once more for its
+# memory peak
+def measure(func, repeat=3, peak=True):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    stats = {"seconds": statistics.median(timings), "min_seconds": min(timings)}
+    if peak:
+        stats["peak_bytes"] = memory_peak(func)
+    return result, stats
+
+
+def max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+# data_prep_day.py end to end, in a scratch directory so the real cache and
+# outputs are left alone: a full build, then a rebuild with nothing changed
+def bench_prep(repeat):
+    import data_prep_day
+
+    missing = [f"madrid_{year}.csv" for year in data_prep_day.YEARS if not os.path.exists(f"madrid_{year}.csv")]
+    if missing or not os.path.exists("stations.csv"):
+        return {"skipped": "raw madrid_YYYY.csv / stations.csv files not found"}
+
+    source = os.getcwd()
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        for file_name in ["stations.csv", *(f"madrid_{year}.csv" for year in data_prep_day.YEARS)]:
+            os.symlink(os.path.join(source, file_name), os.path.join(scratch, file_name))
+        os.chdir(scratch)
+        try:
+            def full():
+                data = data_prep_day.build_daily_averages(full=True)
+                data_prep_day.write_output(data, "arrow")
+
+            def incremental():
+                data = data_prep_day.build_daily_averages()
+                data_prep_day.write_output(data, "arrow")
+
+            _, results["full"] = measure(full, repeat)
+            _, results["incremental"] = measure(incremental, repeat)
+        finally:
+            os.chdir(source)
+    return results
+
+
+# The steps of the app startup one by one: reading the data, the station
+# name / area merge, the aggregate cube and the Prophet fits
+def bench_startup(repeat):
+    import analytics
+    import data_store
+    import forecasting
+
+    results = {}
+    station_data, results["load_station_data"] = measure(data_store.load_station_data, repeat)
+    metadata, results["load_metadata"] = measure(data_store.load_metadata, repeat)
+    daily, results["split_tables"] = measure(
+        lambda: data_store.split_tables(station_data, metadata)[0], repeat
+    )
+    codes = daily["station"]
+    stations, results["build_stations"] = measure(
+        lambda: data_store.build_stations(station_data, codes, metadata), repeat
+    )
+    cube, results["build_cube"] = measure(lambda: data_store.build_cube(daily, stations), repeat)
+    _, results["build_analytics"] = measure(lambda: analytics.build(daily, stations), repeat)
+    average_data_month = data_store.monthly_averages(cube)
+    # Prophet fits take seconds each, they are run once
+    prophet = forecasting.model_params("prophet")
+    _, results["fit_forecasts"] = measure(lambda: forecasting.fit_forecasts(average_data_month, prophet), 1)
+    seasonal = forecasting.model_params("seasonal")
+    _, results["fit_forecasts_seasonal"] = measure(
+        lambda: forecasting.fit_forecasts(average_data_month, seasonal), repeat
+    )
+    return results
+
+
+# Import of app.py as it happens on boot (stored forecasts are used when
+# they exist). Only one import per process, so this case is timed once.
+def bench_import(repeat):
+    rss_before = max_rss_bytes()
+    start = time.perf_counter()
+    import app  # noqa: F401
+
+    return {
+        "app": {
+            "seconds": time.perf_counter() - start,
+            "rss_bytes": max_rss_bytes() - rss_before,
+        }
+    }
+
+
+# Figure builders behind each callback, called with every value of their
+# dropdowns (and year sliders). The figure cache is bypassed, so this is the
+# cost of a cache miss: building and encoding the figure. The daily chart is
+# drawn over its whole date range.
+def callback_cases(app):
+    views = ["Percentage", "Concentration"]
+    daily_view = {"width": app.DAILY_DEFAULT_WIDTH, "range": None}
+    return {
+        "update_map": (app.map_figure, itertools.product(app.pollutants, app.years)),
+        "update_line_chart": (app.update_line_chart, itertools.product(["All", *app.pollutants], views)),
+        "update_forecast": (app.forecast_figure, itertools.product(app.pollutants, ["all"])),
+        "update_graph": (app.update_graph, itertools.product(app.cigarette_years)),
+        "update_seasonal_chart": (app.update_seasonal_chart, itertools.product(app.pollutants)),
+        "update_station_type_bar_chart": (
+            app.station_type_bar_figure,
+            itertools.product(app.pollutants, app.years),
+        ),
+        "update_daily_chart": (
+            app.daily_figure,
+            itertools.product(app.store.stations.index, app.pollutants, ["lttb", "min_max"], [daily_view]),
+        ),
+        "update_exceedance_chart": (
+            app.update_exceedance_chart,
+            itertools.product(app.pollutants, ["station", "area"]),
+        ),
+        "update_rolling_chart": (
+            app.update_rolling_chart,
+            itertools.product(app.store.stations.index, app.pollutants),
+        ),
+        "update_percentile_chart": (
+            app.update_percentile_chart,
+            itertools.product(app.store.stations.index, app.pollutants),
+        ),
+    }
+
+
+def bench_callbacks(repeat):
+    import plotly.io as pio
+
+    import app
+    import figure_encoding
+
+    results = {}
+    for name, (builder, inputs) in callback_cases(app).items():
+        build = getattr(builder, "__wrapped__", builder)
+        runs = {}
+        arguments = {}
+        for args in inputs:
+            key = "|".join(str(arg) for arg in args if not isinstance(arg, dict))
+            arguments[key] = args
+            figure, runs[key] = measure(
+                lambda: figure_encoding.encode_figure(build(*args).to_dict()), repeat, peak=False
+            )
+            runs[key]["payload_bytes"] = len(pio.to_json(figure, validate=False))
+        # The memory peak is taken once per callback, on its slowest input
+        slowest = max(runs, key=lambda key: runs[key]["seconds"])
+        args = arguments[slowest]
+        seconds = [run["seconds"] for run in runs.values()]
+        results[name] = {
+            "seconds": statistics.median(seconds),
+            "max_seconds": max(seconds),
+            "peak_bytes": memory_peak(lambda: figure_encoding.encode_figure(build(*args).to_dict())),
+            "peak_input": slowest,
+            "payload_bytes": max(run["payload_bytes"] for run in runs.values()),
+            "inputs": runs,
+        }
+    return results
+
+
+BENCHMARKS = {
+    "prep": bench_prep,
+    "startup": bench_startup,
+    "import": bench_import,
+    "callbacks": bench_callbacks,
+}
+
+
+def run_case(case, repeat):
+    results = BENCHMARKS[case](repeat)
+    results["max_rss_bytes"] = max_rss_bytes()
+    return results
+
+
+# Run a case in a child process and read its results from stdout. Figures
+# are cached in a scratch directory so the benchmark never reuses (or fills)
+# the real figure cache.
+def run_child(case, repeat, figure_cache_dir):
+    env = dict(os.environ, FIGURE_CACHE_DIR=figure_cache_dir)
+    completed = subprocess.run(
+        [sys.executable, __file__, "--child", case, "--repeat", str(repeat)],
+        env=env,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return json.loads(completed.stdout.decode().splitlines()[-1])
+
+
+# Flatten results into {"case.step.metric": value}, which is what baselines
+# are compared on. Per-input details are kept in the file but not compared.
+def flatten(results, prefix=""):
+    metrics = {}
+    for key, value in results.items():
+        if key == "inputs":
+            continue
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            metrics[f"{prefix}{key}"] = value
+    return metrics
+
+
+def metric_unit(metric):
+    return "seconds" if metric.endswith("seconds") else "bytes"
+
+
+def compare(metrics, baseline):
+    regressions = []
+    for metric, value in sorted(metrics.items()):
+        old = baseline.get(metric)
+        if not old:
+            continue
+        unit = metric_unit(metric)
+        if unit == "seconds" and max(value, old) < NOISE_SECONDS:
+            continue
+        change = value / old - 1
+        if change > TOLERANCE[unit]:
+            regressions.append((metric, old, value, change))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, results, metrics, repeat):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    document = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "metrics": metrics,
+        "results": results,
+    }
+    with open(path + ".tmp", "w") as f:
+        json.dump(document, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)["metrics"]
+    except FileNotFoundError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the data prep, the app startup and the callbacks")
+    parser.add_argument(
+        "--case",
+        choices=CASES,
+        action="append",
+        help=f"benchmark to run, can be repeated (default: all of {', '.join(CASES)})",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per measurement (default: 3)")
+    parser.add_argument("--output", default=LATEST_FILE, help=f"results file (default: {LATEST_FILE})")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help=f"baseline to compare with (default: {BASELINE_FILE})")
+    parser.add_argument("--save-baseline", action="store_true", help="also save the results as the new baseline")
+    parser.add_argument("--child", choices=CASES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_case(args.child, args.repeat)))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as figure_cache_dir:
+        for case in args.case or CASES:
+            print(f"Running {case}...", file=sys.stderr)
+            results[case] = run_child(case, args.repeat, figure_cache_dir)
+    metrics = flatten(results)
+
+    for metric, value in sorted(metrics.items()):
+        print(f"{metric:60} {value:>14.4f}" if metric_unit(metric) == "seconds" else f"{metric:60} {value:>14,d}")
+    save_results(args.output, results, metrics, args.repeat)
+    print(f"Wrote {args.output}")
+
+    baseline = load_baseline(args.baseline)
+    if args.save_baseline:
+        save_results(args.baseline, results, metrics, args.repeat)
+        print(f"Wrote {args.baseline}")
+    elif baseline is None:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+    else:
+        regressions = compare(metrics, baseline)
+        for metric, old, value, change in regressions:
+            print(f"REGRESSION {metric}: {old:.6g} -> {value:.6g} (+{change:.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,336 @@
+import argparse
+import functools
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
-import matplotlib.pyplot as plt
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+import hourly_data
+
+YEARS = range(2001, 2019)
+POLLUTANTS = ["BEN", "CO", "NO_2", "SO_2", "O_3", "PM25", "PM10"]
+VALUE_COLUMNS = [*POLLUTANTS, "Cigarettes"]
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Columns read from the raw files, everything else is skipped while parsing
+RAW_DTYPES = {"date": str, "station": "int32", **{pollutant: "float64" for pollutant in POLLUTANTS}}
+STATION_DTYPES = {"id": "int32", "name": str, "lon": "float64", "lat": "float64", "elevation": "float64"}
+
+# Per-year partial aggregates and the manifest used for incremental rebuilds
+CACHE_DIR = "prep_cache"
+MANIFEST_FILE = "manifest.json"
+
+# Output files written by this script, by format. The Arrow IPC file is the
+# default because app.py can memory-map it instead of parsing it.
+OUTPUT_FILES = {
+    "arrow": "avg_data_day.arrow",
+    "parquet": "avg_data_day.parquet",
+    "csv": "avg_data_day.csv",
+}
+
+
+def prepare_hourly(hourly_data):
+    dates = pd.to_datetime(hourly_data.pop("date"), format=DATE_FORMAT)
+    hourly_data["day"] = dates.dt.normalize()
+    return hourly_data.reindex(columns=["station", "day", *POLLUTANTS])
+
+
+# Reduce hourly rows to daily sums and counts per station. Sums and counts
+# (rather than means) let days that span two files be merged exactly.
+def daily_sums(hourly_data):
+    partial = hourly_data.groupby(["station", "day"])[POLLUTANTS].agg(["sum", "count"])
+    partial.columns = [f"{pollutant}_{stat}" for pollutant, stat in partial.columns]
+    return partial.reset_index()
+
+
+def aggregate_year(file_name, chunksize=None):
+    # Read only the columns we keep, with their types declared up front
+    read_options = {"usecols": lambda column: column in RAW_DTYPES, "dtype": RAW_DTYPES}
+    if chunksize is None:
+        return daily_sums(prepare_hourly(pd.read_csv(file_name, **read_options)))
+
+    # Streaming mode: only one chunk of hourly rows is held at a time. The
+    # rows of the last day in each chunk are carried into the next one, so in
+    # date-ordered files every station/day is summed in a single groupby and
+    # the means are identical to the ones computed from the whole file.
+    partials = []
+    carry = None
+    with pd.read_csv(file_name, chunksize=chunksize, **read_options) as reader:
+        for chunk in reader:
+            chunk = prepare_hourly(chunk)
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            held = chunk["day"] == chunk["day"].iloc[-1]
+            carry = chunk[held]
+            if not held.all():
+                partials.append(daily_sums(chunk[~held]))
+    if carry is not None:
+        partials.append(daily_sums(carry))
+    # Days split across chunks (only in files that are not date-ordered)
+    # are merged here
+    return pd.concat(partials).groupby(["station", "day"], as_index=False).sum()
+
+
+# The manifest records, for every yearly file, the size, mtime and hash it
+# had when its partial aggregate was last written to the cache directory
+def load_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    # Partials written for another set of columns cannot be reused
+    if manifest.get("pollutants") != POLLUTANTS:
+        return {}
+    return manifest.get("files", {})
+
+
+def save_manifest(cache_dir, files):
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"pollutants": POLLUTANTS, "files": files}, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def file_hash(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Compare a file with its manifest entry. The hash is only computed when the
+# size or mtime changed, so untouched files cost a single stat call. A file
+# whose content did not change keeps the rest of its entry (such as the
+# hourly dataset written from it).
+def file_state(file_name, entry, cache_dir):
+    stat = os.stat(file_name)
+    state = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    partial_path = os.path.join(cache_dir, partial_file(file_name))
+    if entry is None or not os.path.exists(partial_path):
+        return state, False
+    if entry["size"] == state["size"] and entry["mtime_ns"] == state["mtime_ns"]:
+        return entry, True
+    state["sha256"] = file_hash(file_name)
+    if state["sha256"] == entry["sha256"]:
+        return {**entry, **state}, True
+    return state, False
+
+
+def partial_file(file_name):
+    return os.path.splitext(file_name)[0] + ".arrow"
+
+
+# Files of the hourly dataset written from one yearly file. They are named
+# after it, so rewriting a year only replaces its own files.
+def hourly_files(file_name, hourly_dir):
+    stem = os.path.splitext(file_name)[0]
+    return glob.glob(os.path.join(hourly_dir, "*", "*", f"{stem}-*.parquet"))
+
+
+def hourly_batches(file_name, chunksize):
+    read_options = {"usecols": lambda column: column in RAW_DTYPES, "dtype": RAW_DTYPES}
+    if chunksize is None:
+        chunks = [pd.read_csv(file_name, **read_options)]
+    else:
+        chunks = pd.read_csv(file_name, chunksize=chunksize, **read_options)
+    for chunk in chunks:
+        dates = pd.to_datetime(chunk.pop("date"), format=DATE_FORMAT)
+        # Pollutants missing from a file (PM25 in the early years) are empty
+        chunk = chunk.reindex(columns=["station", *POLLUTANTS])
+        hourly = pd.DataFrame(
+            {
+                "date": dates.astype("datetime64[s]"),
+                **{pollutant: chunk[pollutant].astype("float32") for pollutant in POLLUTANTS},
+                "year": hourly_data.partition_year(dates).astype("int16"),
+                "station": chunk["station"],
+            }
+        ).sort_values(["date", "station"], kind="stable")
+        yield pa.RecordBatch.from_pandas(hourly, schema=hourly_data.SCHEMA, preserve_index=False)
+
+
+# Write the hourly readings of one yearly file to the partitioned dataset
+def write_hourly(file_name, hourly_dir, chunksize=None):
+    for old_file in hourly_files(file_name, hourly_dir):
+        os.remove(old_file)
+    ds.write_dataset(
+        hourly_batches(file_name, chunksize),
+        hourly_dir,
+        schema=hourly_data.SCHEMA,
+        format="parquet",
+        partitioning=hourly_data.PARTITIONING,
+        basename_template=os.path.splitext(file_name)[0] + "-{i}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        max_rows_per_group=hourly_data.ROW_GROUP_ROWS,
+        min_rows_per_group=hourly_data.ROW_GROUP_ROWS,
+        preserve_order=True,
+    )
+    return file_name
+
+
+def build_daily_averages(workers=None, cache_dir=CACHE_DIR, full=False, chunksize=None, hourly_dir=None):
+    file_names = [f"madrid_{year}.csv" for year in YEARS]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = {} if full else load_manifest(cache_dir)
+    files = {}
+    changed = []
+    for file_name in file_names:
+        state, fresh = file_state(file_name, manifest.get(file_name), cache_dir)
+        files[file_name] = state
+        if not fresh:
+            changed.append(file_name)
+
+    # The hourly dataset is rewritten for the files that changed and the ones
+    # it was never written for (into this directory)
+    hourly_pending = []
+    if hourly_dir is not None:
+        hourly_pending = [
+            file_name
+            for file_name in file_names
+            if file_name in changed
+            or files[file_name].get("hourly_dir") != hourly_dir
+            or not hourly_files(file_name, hourly_dir)
+        ]
+
+    # Only the files that changed since the last run are read again, in
+    # parallel, one process per file
+    if changed or hourly_pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            aggregate = functools.partial(aggregate_year, chunksize=chunksize)
+            for file_name, partial in zip(changed, executor.map(aggregate, changed)):
+                partial.to_feather(os.path.join(cache_dir, partial_file(file_name)))
+                if "sha256" not in files[file_name]:
+                    files[file_name]["sha256"] = file_hash(file_name)
+            write = functools.partial(write_hourly, hourly_dir=hourly_dir, chunksize=chunksize)
+            for file_name in executor.map(write, hourly_pending):
+                files[file_name]["hourly_dir"] = hourly_dir
+    save_manifest(cache_dir, files)
+    print(f"Reprocessed {len(changed)} of {len(file_names)} yearly files")
+    if hourly_dir is not None:
+        print(f"Wrote the hourly data of {len(hourly_pending)} yearly files to {hourly_dir}")
+
+    partials = [
+        pd.read_feather(os.path.join(cache_dir, partial_file(file_name)))
+        for file_name in file_names
+    ]
+    totals = pd.concat(partials).groupby(["station", "day"]).sum()
+    averaged_data = pd.DataFrame(
+        {
+            pollutant: totals[f"{pollutant}_sum"] / totals[f"{pollutant}_count"]
+            for pollutant in POLLUTANTS
+        }
+    )
+
+    # Join the station metadata once, on the aggregated rows
+    station_data = pd.read_csv("stations.csv", usecols=STATION_DTYPES.keys(), dtype=STATION_DTYPES)
+    averaged_data = averaged_data.reset_index().merge(
+        station_data, left_on="station", right_on="id", how="inner"
+    )
+    averaged_data['year'] = averaged_data['day'].dt.year
+    averaged_data['month'] = averaged_data['day'].dt.month
+    averaged_data = averaged_data.set_index(['name', 'day', 'year', 'month']).sort_index()
+    averaged_data = averaged_data[[*POLLUTANTS, "station", "lon", "lat", "elevation"]]
+
+    # Convert PM25 to cigarette equivalents per day
+    averaged_data['Cigarettes'] = averaged_data['PM25'] / 22
+
+    return averaged_data
 
-all_merged_data = []
 
-# Read stations.csv
-station_data = pd.read_csv("stations.csv")
+# Pin narrow, explicit column types so the columnar output does not depend on
+# what pandas happens to infer. Station names are dictionary encoded, days
+# stored as millisecond timestamps and the daily means as float32, which is
+# what app.py keeps in memory, so its memory-mapped columns need no
+# conversion.
+def to_typed_table(averaged_data):
+    data = averaged_data.reset_index()
+    data["day"] = pd.to_datetime(data["day"])
+    data["year"] = data["year"].astype("int16")
+    data["month"] = data["month"].astype("int8")
+    data["name"] = data["name"].astype("category")
+    data[VALUE_COLUMNS] = data[VALUE_COLUMNS].astype("float32")
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    columns = {"day": table.column("day").cast(pa.timestamp("ms"))}
+    # Missing means are stored as NaN rather than as nulls, which pandas would
+    # have to copy the column to turn into NaN
+    for column in VALUE_COLUMNS:
+        columns[column] = pa.array(data[column].to_numpy(), type=pa.float32())
+    for name, column in columns.items():
+        table = table.set_column(table.schema.get_field_index(name), name, column)
+    return table
 
-# Loop through files from 2001 to 2018
-for year in range(2001, 2019):
-    file_name = f"madrid_{year}.csv"
-    
-    # Read the year's data
-    yearly_data = pd.read_csv(file_name)
 
-    # Merge on 'id'
-    merged_data = pd.merge(yearly_data, station_data, left_on="station", right_on="id", how="left")
-    
-    #print(merged_data)
-    all_merged_data.append(merged_data)
+def write_output(averaged_data, output_format):
+    file_name = OUTPUT_FILES[output_format]
+    if output_format == "csv":
+        averaged_data.to_csv(file_name, index=True)
+    elif output_format == "parquet":
+        table = to_typed_table(averaged_data)
+        pq.write_table(table, file_name)
+    else:
+        # Uncompressed Arrow IPC so readers can memory-map it without decoding
+        table = to_typed_table(averaged_data)
+        feather.write_feather(table, file_name, compression="uncompressed")
+    return file_name
 
-combined_data = pd.concat(all_merged_data, ignore_index=True)
 
-# Convert the 'date' column to datetime format in the combined_data DataFrame
-combined_data['date'] = pd.to_datetime(combined_data['date'])
+def main():
+    parser = argparse.ArgumentParser(description="Build the daily averages used by app.py")
+    parser.add_argument(
+        "--format",
+        choices=sorted(OUTPUT_FILES),
+        action="append",
+        help="output format, can be repeated (default: arrow)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes reading the yearly files (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=CACHE_DIR,
+        help=f"directory holding the manifest and per-year partials (default: {CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="ignore the manifest and reprocess every yearly file",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="stream each yearly file in chunks of this many rows to bound memory",
+    )
+    parser.add_argument(
+        "--hourly",
+        nargs="?",
+        const=hourly_data.HOURLY_DIR,
+        metavar="DIR",
+        help="also keep the hourly readings, as a Parquet dataset partitioned by year "
+        f"and station (default directory: {hourly_data.HOURLY_DIR})",
+    )
+    args = parser.parse_args()
 
-combined_data['day'] = combined_data['date'].dt.date
-combined_data['year'] = combined_data['date'].dt.year
-combined_data['month'] = combined_data['date'].dt.month
+    averaged_data = build_daily_averages(
+        workers=args.workers,
+        cache_dir=args.cache_dir,
+        full=args.full,
+        chunksize=args.chunksize,
+        hourly_dir=args.hourly,
+    )
+    for output_format in args.format or ["arrow"]:
+        print(f"Wrote {write_output(averaged_data, output_format)}")
 
-# Group by 'station' to calculate averages for numeric columns
-averaged_data = combined_data.groupby(['name', 'day', 'year', 'month']).mean(numeric_only=True)
-# Convert PM25 to cigarette equivalents per day
-averaged_data['Cigarettes'] = averaged_data['PM25'] / 22
 
-averaged_data.to_csv("avg_data_day.csv", index=True)  # Exclude row indices
+if __name__ == "__main__":
+    main()
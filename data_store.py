@@ -0,0 +1,244 @@
+import hashlib
+import logging
+import os
+import threading
+import unicodedata
+from dataclasses import dataclass
+
+import pandas as pd
+import pyarrow.feather as feather
+
+import metrics
+
+POLLUTANTS = ["BEN", "CO", "NO_2", "SO_2", "O_3", "PM25", "PM10"]
+VALUE_COLUMNS = [*POLLUTANTS, "Cigarettes"]
+
+logger = logging.getLogger(__name__)
+
+METADATA_FILE = "informacion_estaciones_red_calidad_aire.csv"
+DATA_FILES = [
+    "avg_data_day.arrow",
+    "avg_data_day.parquet",
+    "avg_data_day.csv",
+    METADATA_FILE,
+]
+
+
+# Everything the app reads, built once at startup and never modified after.
+# `daily` holds one row per station and day with compact column types and
+# the station code as key, `stations` one row per station code with its
+# name, coordinates and area, and `cube` the precomputed means the charts
+# select from.
+@dataclass(frozen=True)
+class DataStore:
+    daily: pd.DataFrame
+    stations: pd.DataFrame
+    cube: dict
+
+
+# Read the output of data_prep_day.py. The Arrow file is memory-mapped so its
+# columns are shared with the page cache instead of being parsed into every
+# worker; the CSV export is only used when no columnar file exists.
+def load_station_data():
+    if os.path.exists("avg_data_day.arrow"):
+        table = feather.read_table("avg_data_day.arrow", memory_map=True)
+        data = table.to_pandas(split_blocks=True, date_as_object=False)
+    elif os.path.exists("avg_data_day.parquet"):
+        data = pd.read_parquet("avg_data_day.parquet", memory_map=True)
+    else:
+        data = pd.read_csv("avg_data_day.csv")
+
+    # Missing daily means stay missing (NaN) here, so mapped columns stay
+    # mapped; the cube fills them where the charts expect it
+    if data[["lat", "lon"]].isna().any(axis=None):
+        data = data.dropna(subset=["lat", "lon"])
+    return data
+
+
+def load_metadata():
+    return pd.read_csv(METADATA_FILE, sep=";", encoding="utf-8-sig")
+
+
+# Clean and normalize station names
+def clean_text(s):
+    if isinstance(s, str):
+        s = s.strip().lower()
+        s = unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("utf-8")
+        return s
+    return s
+
+
+# Read-only view of a column, without a copy. Frames are built from these so
+# that an in-place write (for example from a callback) raises instead of
+# silently changing data shared by every request.
+def readonly(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        codes.flags.writeable = False
+        return pd.Categorical.from_codes(codes, dtype=values.dtype)
+    array = values.to_numpy()
+    array.flags.writeable = False
+    return array
+
+
+def frozen_frame(columns, index=None):
+    return pd.DataFrame(
+        {name: readonly(values) for name, values in columns.items()},
+        index=index,
+        copy=False,
+    )
+
+
+# Station dimension: one row per station code found in the daily data, with
+# its name, coordinates and area. The area is matched on the metadata's
+# CODIGO (or CODIGO_CORTO); only stations whose code is unknown fall back to
+# their cleaned name, normalized once per station.
+def build_stations(station_data, codes, metadata):
+    stations = station_data.groupby(codes)[["name", "lat", "lon"]].first()
+    stations["name"] = stations["name"].astype(str)
+
+    area = metadata.set_index("CODIGO")["NOM_TIPO"].reindex(stations.index).to_numpy()
+    missing = pd.isna(area)
+    short_codes = metadata.set_index("CODIGO_CORTO")["NOM_TIPO"]
+    area[missing] = short_codes.reindex(stations.index[missing]).to_numpy()
+    missing = pd.isna(area)
+    if missing.any():
+        metadata = metadata.assign(station_clean=metadata["ESTACION"].map(clean_text))
+        names = metadata.drop_duplicates("station_clean").set_index("station_clean")["NOM_TIPO"]
+        clean_names = [clean_text(name) for name in stations["name"][missing]]
+        area[missing] = names.reindex(clean_names).to_numpy()
+    unmatched = stations["name"][pd.isna(area)]
+    if len(unmatched):
+        logger.warning("No area found for stations: %s", ", ".join(unmatched))
+    stations["NOM_TIPO"] = pd.Categorical(area)
+
+    return frozen_frame(stations, index=pd.Index(stations.index, name="station"))
+
+
+# Split the daily rows into a compact fact table, carrying only the integer
+# station code, narrow numeric types and values coerced to numbers once, and
+# the station dimension with everything known about each station
+def split_tables(station_data, metadata):
+    # Older CSV exports only have the code as the float "id" column
+    code_column = "station" if "station" in station_data else "id"
+    codes = station_data[code_column].astype("int32", copy=False)
+
+    # Columns already stored with these types (the Arrow output of
+    # data_prep_day.py) are used as they are, without a copy
+    daily = frozen_frame(
+        {
+            "station": codes,
+            "day": pd.to_datetime(station_data["day"]),
+            "year": station_data["year"].astype("int16", copy=False),
+            "month": station_data["month"].astype("int8", copy=False),
+            **{
+                column: pd.to_numeric(station_data[column], errors="coerce").astype(
+                    "float32", copy=False
+                )
+                for column in VALUE_COLUMNS
+            },
+        }
+    )
+    return daily, build_stations(station_data, codes, metadata)
+
+
+# Levels of the precomputed aggregate cube and the columns grouping each one
+CUBE_LEVELS = {
+    "year": ["year"],
+    "year_month": ["year", "month"],
+    "station_year": ["station", "year"],
+    "station_year_month": ["station", "year", "month"],
+    "area_year": ["NOM_TIPO", "year"],
+    "station_year_measured": ["station", "year"],
+}
+# Levels whose means skip the missing days instead of counting them as 0:
+# the station forecasts are only fitted on measured months, and the map
+# surface only interpolates between stations measuring the pollutant
+MEASURED_LEVELS = ["station_year_month", "station_year_measured"]
+
+
+# Mean of every pollutant and of Cigarettes at each level of CUBE_LEVELS,
+# computed in float64 even though the values are stored as float32. Missing
+# days count as 0, as the charts have always drawn them, except at
+# MEASURED_LEVELS where a group without any value is missing. Areas are
+# looked up in the station dimension by position, and the station level is
+# labelled afterwards with the name and coordinates the map shows.
+def build_cube(daily, stations):
+    positions = stations.index.get_indexer(daily["station"])
+    areas = stations["NOM_TIPO"].array
+    keys = {
+        "station": daily["station"],
+        "NOM_TIPO": pd.Categorical.from_codes(areas.codes[positions], dtype=areas.dtype),
+        "year": daily["year"],
+        "month": daily["month"],
+    }
+    measured = daily[VALUE_COLUMNS].astype("float64")
+    values = measured.fillna(0)
+    cube = {}
+    for level, columns in CUBE_LEVELS.items():
+        groups = [pd.Series(keys[column], name=column, index=daily.index) for column in columns]
+        source = measured if level in MEASURED_LEVELS else values
+        cube[level] = source.groupby(groups, observed=True).mean()
+
+    by_station = cube["station_year"]
+    codes = by_station.index.get_level_values("station")
+    labels = stations.loc[codes]
+    by_station.index = pd.MultiIndex.from_arrays(
+        [
+            codes,
+            labels["name"],
+            labels["lat"],
+            labels["lon"],
+            by_station.index.get_level_values("year"),
+        ],
+        names=["station", "name", "lat", "lon", "year"],
+    )
+    return cube
+
+
+def load():
+    with metrics.startup_phase("data_load"):
+        station_data = load_station_data()
+    with metrics.startup_phase("metadata_merge"):
+        daily, stations = split_tables(station_data, load_metadata())
+    with metrics.startup_phase("aggregation"):
+        cube = build_cube(daily, stations)
+    return DataStore(daily=daily, stations=stations, cube=cube)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# The store of this process, loaded on first use. Run under gunicorn with
+# gunicorn.conf.py, app.py calls this in the master before the workers are
+# forked, so they all share its (read-only, array backed) pages instead of
+# each loading a private copy.
+def get():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = load()
+    return _store
+
+
+# City-wide monthly mean of every pollutant, the input of the forecasts
+def monthly_averages(cube):
+    return cube["year_month"][POLLUTANTS].reset_index()
+
+
+# Monthly mean of every pollutant at each station, the input of the station
+# forecasts
+def station_monthly_averages(cube):
+    return cube["station_year_month"][POLLUTANTS].reset_index()
+
+
+# Identify the data on disk by the size and mtime of the input files, so that
+# anything derived from it (such as cached figures) changes with it
+def data_version():
+    digest = hashlib.sha256()
+    for file_name in DATA_FILES:
+        if os.path.exists(file_name):
+            stat = os.stat(file_name)
+            digest.update(f"{file_name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
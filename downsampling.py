@@ -0,0 +1,53 @@
+import numpy as np
+
+# Both functions take the points of a series sorted by x, without missing
+# values, and return the (sorted) positions of the points to draw.
+
+
+# Largest-Triangle-Three-Buckets: keeps `threshold` points, the first and the
+# last one and, in every bucket in between, the point forming the largest
+# triangle with the point kept in the previous bucket and the mean of the
+# next bucket. Keeps the visual shape of the line, peaks included.
+def lttb(x, y, threshold):
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # Edges of the threshold - 2 buckets holding the points between the
+    # first and the last one
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    # Mean of every bucket, and of the last point for the last bucket
+    sizes = np.diff(edges)
+    mean_x = np.append(np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / sizes, x[-1])
+    mean_y = np.append(np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / sizes, y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_x, next_y = mean_x[bucket + 1], mean_y[bucket + 1]
+        area = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + np.argmax(area)
+        selected[bucket + 1] = previous
+    return selected
+
+
+# Min/max buckets: the lowest and the highest point of each of `buckets`
+# equal-count buckets. Cheaper than LTTB and never hides an extreme value.
+def min_max(y, buckets):
+    n = len(y)
+    if 2 * buckets >= n or buckets < 1:
+        return np.arange(n)
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    bucket_of = np.repeat(np.arange(buckets), np.diff(edges))
+    # Sorted by bucket, then by value: the first and last point of each
+    # bucket are its minimum and maximum
+    order = np.lexsort((y, bucket_of))
+    return np.unique(np.concatenate([order[edges[:-1]], order[edges[1:] - 1]]))
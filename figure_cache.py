@@ -0,0 +1,105 @@
+import argparse
+import functools
+import hashlib
+import inspect
+import os
+
+import diskcache
+
+import figure_encoding
+import metrics
+
+CACHE_DIR = os.environ.get("FIGURE_CACHE_DIR", "figure_cache")
+# Upper bound of the on-disk cache in bytes, least recently used figures are
+# evicted first once it is reached
+SIZE_LIMIT = int(os.environ.get("FIGURE_CACHE_SIZE_LIMIT", 256 * 1024 * 1024))
+# A worker holding a compute lock longer than this is assumed to have died
+LOCK_EXPIRE = 120
+
+# One cache directory shared by every gunicorn worker (diskcache is safe to
+# use from several processes and threads at once)
+cache = diskcache.Cache(
+    CACHE_DIR,
+    size_limit=SIZE_LIMIT,
+    eviction_policy="least-recently-used",
+)
+
+
+def source_hash(func):
+    with open(inspect.getsourcefile(func), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+# Return the cached value of `key`, building and storing it with `build` on
+# a miss. Concurrent requests for the same missing key wait on a lock so only
+# one of them builds the value.
+def lookup(name, key, build):
+    value = cache.get(key)
+    metrics.figure_cache_lookup(name, value is not None)
+    if value is not None:
+        return value
+    with diskcache.Lock(cache, ("lock", key), expire=LOCK_EXPIRE):
+        value = cache.get(key)
+        if value is None:
+            value = build()
+            cache.set(key, value)
+    return value
+
+
+# Cache the figure returned by a callback, keyed by the callback name, its
+# inputs, the version of the data, the source of the module defining it and
+# the figure output settings. Figures are stored already encoded for output.
+def cached_figure(name, data_version):
+    def decorator(func):
+        version = (
+            data_version,
+            source_hash(func),
+            source_hash(figure_encoding.encode_figure),
+            figure_encoding.settings(),
+        )
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return lookup(
+                name,
+                (name, version, args),
+                lambda: figure_encoding.encode_figure(func(*args).to_dict()),
+            )
+
+        return wrapper
+
+    return decorator
+
+
+# Same for any other value derived from the data, such as the map's raster
+# frames, stored as returned
+def cached_value(name, data_version):
+    def decorator(func):
+        version = (data_version, source_hash(func))
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return lookup(name, (name, version, args), lambda: func(*args))
+
+        return wrapper
+
+    return decorator
+
+
+# Drop every cached figure, e.g. after deploying new data with the same mtime
+def invalidate():
+    cache.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the figure cache used by app.py")
+    parser.add_argument("--clear", action="store_true", help="remove every cached figure")
+    args = parser.parse_args()
+
+    if args.clear:
+        invalidate()
+    print(f"{CACHE_DIR}: {len(cache)} entries, {cache.volume()} bytes")
+
+
+if __name__ == "__main__":
+    main()
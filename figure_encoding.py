@@ -0,0 +1,119 @@
+import base64
+import os
+
+import numpy as np
+
+# Figure output settings, read from the environment like the figure cache
+# ones. FIGURE_ENCODING is "binary" (numeric arrays sent as base64 typed
+# arrays) or "json" (plain lists).
+ENCODING = os.environ.get("FIGURE_ENCODING", "binary")
+# Significant digits kept in numeric arrays, empty to keep full precision.
+# Up to 7 digits fit in float32, which halves the size of binary arrays.
+PRECISION = int(os.environ.get("FIGURE_PRECISION", "6") or 0) or None
+# Scatter traces with more points than this are drawn with WebGL
+WEBGL_THRESHOLD = int(os.environ.get("FIGURE_WEBGL_THRESHOLD", 1000))
+
+# Typed array types understood by plotly.js, smallest first
+INTEGER_TYPES = [np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32]
+WEBGL_TYPES = {"scatter": "scattergl"}
+
+
+# Part of the figure cache key, so cached figures follow the settings
+def settings():
+    return (ENCODING, PRECISION, WEBGL_THRESHOLD)
+
+
+# Numeric array held by a figure attribute, or None for anything else
+# (strings, colorscales, scalars...)
+def to_array(values):
+    if isinstance(values, dict) and "bdata" in values:
+        array = np.frombuffer(base64.b64decode(values["bdata"]), dtype=values["dtype"])
+        if "shape" in values:
+            array = array.reshape([int(n) for n in str(values["shape"]).split(",")])
+        return array
+    if not isinstance(values, (list, tuple, np.ndarray)):
+        return None
+    array = np.asarray(values)
+    if array.dtype.kind not in "iufM" or array.size == 0:
+        return None
+    return array
+
+
+def round_significant(array):
+    finite = np.isfinite(array) & (array != 0)
+    magnitude = np.zeros(array.shape)
+    magnitude[finite] = np.floor(np.log10(np.abs(array[finite])))
+    scale = 10.0 ** (PRECISION - 1 - magnitude)
+    return np.round(array * scale) / scale
+
+
+# Smallest type holding the values: integers when they are all whole numbers,
+# float32 when the kept precision fits in it
+def narrow(array):
+    if array.dtype.kind == "f" and np.isfinite(array).all() and (array == np.round(array)).all():
+        array = array.astype(np.int64)
+    if array.dtype.kind in "iu":
+        for integer_type in INTEGER_TYPES:
+            info = np.iinfo(integer_type)
+            if info.min <= array.min() and array.max() <= info.max:
+                return array.astype(integer_type)
+        return array.astype(np.float64)
+    if PRECISION is not None and PRECISION <= 7:
+        return array.astype(np.float32)
+    return array.astype(np.float64)
+
+
+# Dates are sent without their time of day when it is always midnight
+def trim_dates(array):
+    days = array.astype("datetime64[D]")
+    unit = "D" if (days == array).all() else "s"
+    return np.datetime_as_string(array, unit=unit).tolist()
+
+
+def encode_array(values):
+    array = to_array(values)
+    if array is None:
+        return values
+    if array.dtype.kind == "M":
+        return trim_dates(array)
+    if array.dtype.kind == "f" and PRECISION is not None:
+        array = round_significant(array)
+    array = narrow(array)
+    if ENCODING == "json":
+        return array.tolist()
+    spec = {
+        "dtype": array.dtype.str.lstrip("<|="),
+        "bdata": base64.b64encode(np.ascontiguousarray(array, array.dtype.newbyteorder("<"))).decode("ascii"),
+    }
+    if array.ndim > 1:
+        spec["shape"] = ", ".join(map(str, array.shape))
+    return spec
+
+
+def encode_attributes(attributes):
+    return {
+        key: encode_attributes(value) if isinstance(value, dict) and "bdata" not in value else encode_array(value)
+        for key, value in attributes.items()
+    }
+
+
+def encode_trace(trace):
+    trace = encode_attributes(trace)
+    trace_type = trace.get("type", "scatter")
+    points = to_array(trace.get("y", trace.get("x")))
+    if trace_type in WEBGL_TYPES and points is not None and len(points) > WEBGL_THRESHOLD:
+        trace["type"] = WEBGL_TYPES[trace_type]
+    return trace
+
+
+# Copy of a figure dict with every numeric trace array rounded, narrowed and
+# encoded, and large scatter traces switched to WebGL. Layouts are left as is.
+def encode_figure(figure):
+    figure = dict(figure)
+    figure["data"] = [encode_trace(trace) for trace in figure.get("data", [])]
+    if "frames" in figure:
+        figure["frames"] = [
+            {**frame, "data": [encode_trace(trace) for trace in frame.get("data", [])]}
+            for frame in figure["frames"]
+        ]
+    return figure
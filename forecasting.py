@@ -0,0 +1,347 @@
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import statistics
+
+import numpy as np
+import pandas as pd
+
+import data_store
+import jobs
+import metrics
+
+FORECAST_DIR = "forecasts"
+# Station forecasts are only fitted for series with at least this many months
+MIN_MONTHS = 24
+# Seconds a station forecast may take before its job is killed
+JOB_TIMEOUT = 300
+
+# Settings of each forecast engine (see ENGINES below)
+ENGINE_PARAMS = {
+    "prophet": {},
+    # Strength of the ridge penalty on the trend and month coefficients
+    "seasonal": {"alpha": 1.0},
+}
+
+
+# Everything that changes the fitted models is part of the artifact key
+def model_params(model):
+    if model not in ENGINE_PARAMS:
+        raise ValueError(f"Unknown forecast model {model!r}, expected one of {', '.join(ENGINE_PARAMS)}")
+    return {
+        "model": model,
+        "interval_width": 0.95,
+        "periods": 12 * (2030 - 2018),
+        "freq": "ME",
+        **ENGINE_PARAMS[model],
+    }
+
+
+# FORECAST_MODEL=seasonal fits every pollutant in milliseconds instead of
+# the seconds Prophet takes, without importing Prophet at all
+MODEL_PARAMS = model_params(os.environ.get("FORECAST_MODEL", "prophet"))
+
+
+# Key a forecast by the monthly data it was fitted on and the model
+# parameters, so a stored forecast is reused until one of them changes
+def forecast_key(average_data_month, params=MODEL_PARAMS):
+    digest = hashlib.sha256()
+    digest.update(json.dumps(list(average_data_month.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(average_data_month, index=False).values.tobytes())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+# Dates of the history followed by the forecast periods, like Prophet's
+# make_future_dataframe
+def future_dates(history, params):
+    last = history["ds"].max()
+    dates = pd.date_range(start=last, periods=params["periods"] + 1, freq=params["freq"])
+    future = dates[dates > last][: params["periods"]]
+    return pd.concat([history["ds"], pd.Series(future)], ignore_index=True)
+
+
+# Every engine takes the monthly history of one pollutant (columns ds and y)
+# and returns its forecast over the history and the future periods, with at
+# least the columns ds, yhat, yhat_lower and yhat_upper
+def fit_prophet(history, params):
+    # Prophet is slow to import, only pay for it when a refit is needed
+    from prophet import Prophet
+
+    model = Prophet(interval_width=params["interval_width"])
+    model.fit(history)
+    future = model.make_future_dataframe(periods=params["periods"], freq=params["freq"])
+    return model.predict(future)
+
+
+# Linear trend plus one level per month of the year, fitted with a ridge
+# regression. The interval is the normal one of a new observation: the
+# residual spread, widened by the uncertainty of the coefficients, which
+# grows the further the trend is extrapolated.
+def fit_seasonal(history, params):
+    from sklearn.linear_model import Ridge
+
+    def features(ds):
+        years = ((ds - history["ds"].min()).dt.days / 365.25).to_numpy()
+        months = np.eye(12)[ds.dt.month.to_numpy() - 1]
+        return np.column_stack([years, months])
+
+    X = features(history["ds"])
+    y = history["y"].to_numpy()
+    model = Ridge(alpha=params["alpha"]).fit(X, y)
+    residuals = y - model.predict(X)
+    sigma = np.sqrt(np.sum(residuals**2) / max(len(y) - X.shape[1] - 1, 1))
+
+    ds = future_dates(history, params)
+    X_future = features(ds)
+    # Leverage of each date with the ridge penalty, the intercept centred out
+    centred = X - X.mean(axis=0)
+    inverse = np.linalg.inv(centred.T @ centred + params["alpha"] * np.eye(X.shape[1]))
+    offsets = X_future - X.mean(axis=0)
+    leverage = 1 / len(y) + np.einsum("ij,jk,ik->i", offsets, inverse, offsets)
+    z = statistics.NormalDist().inv_cdf(0.5 + params["interval_width"] / 2)
+    half_width = z * sigma * np.sqrt(1 + leverage)
+
+    yhat = model.predict(X_future)
+    return pd.DataFrame(
+        {
+            "ds": ds,
+            "trend": model.intercept_ + model.coef_[0] * X_future[:, 0],
+            "yhat": yhat,
+            "yhat_lower": yhat - half_width,
+            "yhat_upper": yhat + half_width,
+        }
+    )
+
+
+ENGINES = {
+    "prophet": fit_prophet,
+    "seasonal": fit_seasonal,
+}
+# Module each engine imports when it first fits
+ENGINE_MODULES = {
+    "prophet": "prophet",
+    "seasonal": "sklearn.linear_model",
+}
+
+
+# Monthly series of one pollutant as the ds and y columns the engines take
+def monthly_history(monthly, pollutant):
+    df = monthly[["year", "month", pollutant]].dropna()
+    df["ds"] = pd.to_datetime(df[["year", "month"]].assign(day=1))
+    df["y"] = df[pollutant]
+    return df[["ds", "y"]].reset_index(drop=True)
+
+
+def fit_forecast(history, params):
+    forecast = ENGINES[params["model"]](history, params)
+    forecast["observed"] = history["y"]  # Observed values
+    return forecast
+
+
+# `progress(done, total)` is called after each pollutant, if given
+def fit_forecasts(average_data_month, params=MODEL_PARAMS, progress=None):
+    forecasts = {}
+    for pollutant in data_store.POLLUTANTS:
+        forecasts[pollutant] = fit_forecast(monthly_history(average_data_month, pollutant), params)
+        if progress is not None:
+            progress(len(forecasts), len(data_store.POLLUTANTS))
+    return forecasts
+
+
+def artifact_path(key, forecast_dir=FORECAST_DIR):
+    return os.path.join(forecast_dir, f"forecast_{key}.arrow")
+
+
+def save_forecasts(forecasts, key, forecast_dir=FORECAST_DIR):
+    os.makedirs(forecast_dir, exist_ok=True)
+    table = pd.concat(
+        [forecast.assign(pollutant=pollutant) for pollutant, forecast in forecasts.items()],
+        ignore_index=True,
+    )
+    # Write to a temporary file first so a reader never sees a partial file
+    path = artifact_path(key, forecast_dir)
+    table.to_feather(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def load_forecasts(key, forecast_dir=FORECAST_DIR):
+    path = artifact_path(key, forecast_dir)
+    if not os.path.exists(path):
+        return None
+    table = pd.read_feather(path)
+    return {
+        pollutant: forecast.drop(columns="pollutant").reset_index(drop=True)
+        for pollutant, forecast in table.groupby("pollutant", sort=False)
+    }
+
+
+# Load the stored forecasts for this data, fitting and storing them first if
+# no artifact matches the current key
+def get_forecasts(average_data_month, forecast_dir=FORECAST_DIR, params=MODEL_PARAMS, progress=None):
+    key = forecast_key(average_data_month, params)
+    with metrics.startup_phase("forecast_load"):
+        forecasts = load_forecasts(key, forecast_dir)
+    if forecasts is None:
+        with metrics.startup_phase("forecast_fit"):
+            forecasts = fit_forecasts(average_data_month, params, progress)
+        save_forecasts(forecasts, key, forecast_dir)
+    return forecasts
+
+
+# Forecasts of every station and pollutant are stored one file per series in
+# a directory keyed like the city-wide ones, with a .error file instead for
+# the series whose fit failed
+def station_forecast_dir(key, forecast_dir=FORECAST_DIR):
+    return os.path.join(forecast_dir, f"stations_{key}")
+
+
+def station_forecast_path(key, station, pollutant, forecast_dir=FORECAST_DIR, suffix=".arrow"):
+    return os.path.join(station_forecast_dir(key, forecast_dir), f"{station}_{pollutant}{suffix}")
+
+
+def save_station_forecast(forecast, key, station, pollutant, forecast_dir=FORECAST_DIR):
+    path = station_forecast_path(key, station, pollutant, forecast_dir)
+    forecast.to_feather(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def save_station_error(error, key, station, pollutant, forecast_dir=FORECAST_DIR):
+    with open(station_forecast_path(key, station, pollutant, forecast_dir, ".error"), "w") as f:
+        f.write(error)
+
+
+# Changes whenever a station forecast is stored or removed
+def station_forecast_stamp(key, forecast_dir=FORECAST_DIR):
+    directory = station_forecast_dir(key, forecast_dir)
+    return os.stat(directory).st_mtime_ns if os.path.isdir(directory) else None
+
+
+# Stored forecast of a station and pollutant, or None with the reason it is
+# missing
+def load_station_forecast(key, station, pollutant, forecast_dir=FORECAST_DIR):
+    path = station_forecast_path(key, station, pollutant, forecast_dir)
+    if os.path.exists(path):
+        return pd.read_feather(path), None
+    error_path = station_forecast_path(key, station, pollutant, forecast_dir, ".error")
+    if os.path.exists(error_path):
+        with open(error_path) as f:
+            return None, f.read().strip().splitlines()[-1]
+    return None, "not fitted yet (python forecasting.py --stations)"
+
+
+# Fit the forecast of every station and pollutant with enough data, each in
+# its own job process (see jobs.py), at most `workers` at a time. Series with
+# fewer than MIN_MONTHS measured months get an error saying so instead. Series
+# already stored are skipped unless `force`, so an interrupted run resumes
+# where it stopped. Returns the number of forecasts fitted and the errors of
+# the failed ones.
+def fit_station_forecasts(
+    station_monthly,
+    params=MODEL_PARAMS,
+    forecast_dir=FORECAST_DIR,
+    workers=None,
+    timeout=JOB_TIMEOUT,
+    force=False,
+):
+    key = forecast_key(station_monthly, params)
+    os.makedirs(station_forecast_dir(key, forecast_dir), exist_ok=True)
+    # Imported once here rather than in every job
+    importlib.import_module(ENGINE_MODULES[params["model"]])
+
+    pending = {}
+    for station, monthly in station_monthly.groupby("station"):
+        for pollutant in data_store.POLLUTANTS:
+            history = monthly_history(monthly, pollutant)
+            stored = os.path.exists(station_forecast_path(key, station, pollutant, forecast_dir))
+            if len(history) < MIN_MONTHS:
+                save_station_error(
+                    f"not enough data ({len(history)} measured months, {MIN_MONTHS} needed)",
+                    key,
+                    station,
+                    pollutant,
+                    forecast_dir,
+                )
+            elif force or not stored:
+                pending[(station, pollutant)] = (history, params)
+
+    fitted = 0
+    errors = {}
+    for (station, pollutant), forecast, error in jobs.run(fit_forecast, pending.items(), workers, timeout):
+        error_path = station_forecast_path(key, station, pollutant, forecast_dir, ".error")
+        if error is None:
+            save_station_forecast(forecast, key, station, pollutant, forecast_dir)
+            if os.path.exists(error_path):
+                os.remove(error_path)
+            fitted += 1
+        else:
+            save_station_error(error, key, station, pollutant, forecast_dir)
+            errors[(station, pollutant)] = error
+    return fitted, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the forecasts shown by app.py and store them on disk")
+    parser.add_argument(
+        "--forecast-dir",
+        default=FORECAST_DIR,
+        help=f"directory holding the forecast artifacts (default: {FORECAST_DIR})",
+    )
+    parser.add_argument(
+        "--model",
+        choices=list(ENGINES),
+        default=MODEL_PARAMS["model"],
+        help=f"forecast engine (default: FORECAST_MODEL or prophet, now {MODEL_PARAMS['model']})",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="refit even if a stored forecast matches the current data",
+    )
+    parser.add_argument(
+        "--stations",
+        action="store_true",
+        help="fit the forecast of every station and pollutant instead of the city-wide ones",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="station forecasts fitted at once (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=JOB_TIMEOUT,
+        help=f"seconds before a station forecast is given up (default: {JOB_TIMEOUT})",
+    )
+    args = parser.parse_args()
+
+    params = model_params(args.model)
+    cube = data_store.load().cube
+    if args.stations:
+        station_monthly = data_store.station_monthly_averages(cube)
+        fitted, errors = fit_station_forecasts(
+            station_monthly, params, args.forecast_dir, args.workers, args.timeout, args.force
+        )
+        for (station, pollutant), error in errors.items():
+            print(f"{station} {pollutant} failed: {error.strip().splitlines()[-1]}")
+        directory = station_forecast_dir(forecast_key(station_monthly, params), args.forecast_dir)
+        print(f"Fitted {fitted} station forecasts ({len(errors)} failed) in {directory}")
+        return
+
+    average_data_month = data_store.monthly_averages(cube)
+    key = forecast_key(average_data_month, params)
+    path = artifact_path(key, args.forecast_dir)
+    if os.path.exists(path) and not args.force:
+        print(f"{path} is up to date")
+        return
+    forecasts = fit_forecasts(average_data_month, params)
+    print(f"Wrote {save_forecasts(forecasts, key, args.forecast_dir)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import gc
+import os
+import shutil
+import tempfile
+
+# gunicorn reads this file automatically when started from the repository
+# root, e.g. with `gunicorn app:server` on Render
+
+wsgi_app = "app:server"
+bind = f"0.0.0.0:{os.environ.get('PORT', '8050')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = 120
+
+# Import app.py, and so load the data store and the forecasts, once in the
+# master. Forked workers share those pages copy-on-write, so adding workers
+# adds throughput without multiplying memory.
+preload_app = True
+
+# Every process writes its metrics to this directory and the /metrics route
+# merges them (prometheus_client multiprocess mode). It has to be set before
+# the app is imported, and is emptied so values of a previous run are not
+# served again.
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "dashboard_metrics")
+)
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir)
+
+
+def when_ready(server):
+    # Move everything loaded so far to the permanent generation. Otherwise a
+    # collection in a worker touches the header of every shared object and
+    # each worker ends up with its own copy of the pages holding them.
+    gc.freeze()
+    server.log.info("Froze %d objects before forking workers", gc.get_freeze_count())
+
+
+def child_exit(server, worker):
+    # Drop the live gauges of the worker from the merged metrics
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
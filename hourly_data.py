@@ -0,0 +1,108 @@
+import argparse
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Hourly readings written by `data_prep_day.py --hourly`, as a Parquet dataset
+# partitioned by year and station (hourly/year=2010/station=28079004/...).
+# Inside each file rows are sorted by date and split in row groups of about a
+# month, so a date range only reads the row groups it overlaps.
+HOURLY_DIR = "hourly"
+POLLUTANTS = ["BEN", "CO", "NO_2", "SO_2", "O_3", "PM25", "PM10"]
+PARTITIONING = ds.partitioning(
+    pa.schema([("year", pa.int16()), ("station", pa.int32())]),
+    flavor="hive",
+)
+SCHEMA = pa.schema(
+    [
+        ("date", pa.timestamp("s")),
+        *((pollutant, pa.float32()) for pollutant in POLLUTANTS),
+        ("year", pa.int16()),
+        ("station", pa.int32()),
+    ]
+)
+ROW_GROUP_ROWS = 24 * 31
+
+
+# Readings are stamped at the end of their hour, so the one at midnight on
+# January 1st covers the last hour of the previous year. Readings are
+# partitioned by the year of the hour they cover, which is also the yearly
+# file they come from.
+def partition_year(dates):
+    return (dates - pd.Timedelta(hours=1)).dt.year
+
+
+def hour_start(timestamp):
+    return pd.Timestamp(timestamp) - pd.Timedelta(hours=1)
+
+
+def available(hourly_dir=HOURLY_DIR):
+    return os.path.isdir(hourly_dir)
+
+
+def dataset(hourly_dir=HOURLY_DIR):
+    return ds.dataset(hourly_dir, format="parquet", partitioning=PARTITIONING, schema=SCHEMA)
+
+
+# Filter on the partition columns (whole directories are skipped) and on the
+# date (row groups outside the range are skipped using their statistics)
+def query_filter(start=None, end=None, stations=None):
+    conditions = []
+    if start is not None:
+        conditions += [
+            ds.field("year") >= hour_start(start).year,
+            ds.field("date") >= pd.Timestamp(start).to_datetime64(),
+        ]
+    if end is not None:
+        conditions += [
+            ds.field("year") <= hour_start(end).year,
+            ds.field("date") < pd.Timestamp(end).to_datetime64(),
+        ]
+    if stations is not None:
+        conditions.append(ds.field("station").isin(list(stations)))
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+
+# Hourly readings from `start` (included) to `end` (excluded) of the given
+# stations and pollutants, all of them when not given. Only the selected
+# columns of the matching partitions and row groups are read.
+def query(start=None, end=None, stations=None, pollutants=None, hourly_dir=HOURLY_DIR):
+    columns = ["date", "station", *(pollutants or POLLUTANTS)]
+    table = dataset(hourly_dir).to_table(
+        columns=columns,
+        filter=query_filter(start, end, stations),
+    )
+    return table.to_pandas().sort_values(["station", "date"], ignore_index=True)
+
+
+# Mean of each pollutant by hour of the day, the hour a reading covers (the
+# 01:00 reading is hour 0)
+def diurnal_cycle(start=None, end=None, stations=None, pollutants=None, hourly_dir=HOURLY_DIR):
+    hourly = query(start, end, stations, pollutants, hourly_dir)
+    hour = (hourly.pop("date") - pd.Timedelta(hours=1)).dt.hour.rename("hour")
+    return hourly.drop(columns="station").groupby(hour).mean()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the hourly dataset written by data_prep_day.py --hourly")
+    parser.add_argument("--start", help="first date, e.g. 2010-01-01")
+    parser.add_argument("--end", help="end date (excluded)")
+    parser.add_argument("--station", type=int, action="append", help="station code, can be repeated")
+    parser.add_argument("--pollutant", choices=POLLUTANTS, action="append", help="pollutant, can be repeated")
+    parser.add_argument("--diurnal", action="store_true", help="print the mean by hour of the day")
+    parser.add_argument("--hourly-dir", default=HOURLY_DIR, help=f"dataset directory (default: {HOURLY_DIR})")
+    args = parser.parse_args()
+
+    run = diurnal_cycle if args.diurnal else query
+    print(run(args.start, args.end, args.station, args.pollutant, args.hourly_dir))
+
+
+if __name__ == "__main__":
+    main()
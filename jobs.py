@@ -0,0 +1,72 @@
+import multiprocessing
+import multiprocessing.connection
+import time
+import traceback
+
+# Processes are forked where possible, so modules the parent already imported
+# (Prophet, scikit-learn) are not imported again by every job
+CONTEXT = multiprocessing.get_context(
+    "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+)
+
+
+def run_job(func, args, connection):
+    try:
+        connection.send((True, func(*args)))
+    except BaseException:
+        connection.send((False, traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+# Run `func(*args)` for every (key, args) of `jobs`, each in its own process
+# and at most `workers` at a time, and yield (key, result, error) as they
+# finish. A job raising, crashing its process or running longer than
+# `timeout` seconds (its process is then killed) only fails that job: it is
+# yielded with its error and a None result.
+def run(func, jobs, workers=None, timeout=None):
+    workers = workers or CONTEXT.cpu_count()
+    pending = list(jobs)[::-1]
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                key, args = pending.pop()
+                reader, writer = CONTEXT.Pipe(duplex=False)
+                process = CONTEXT.Process(target=run_job, args=(func, args, writer), daemon=True)
+                process.start()
+                # Only the job holds the writing end now, so the reader sees
+                # the end of the pipe if the job dies without a result
+                writer.close()
+                deadline = time.monotonic() + timeout if timeout else None
+                running[reader] = (key, process, deadline)
+
+            deadlines = [deadline for _, _, deadline in running.values() if deadline is not None]
+            wait = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+            for reader in multiprocessing.connection.wait(list(running), wait):
+                key, process, _ = running.pop(reader)
+                try:
+                    succeeded, value = reader.recv()
+                except EOFError:
+                    succeeded, value = False, None
+                reader.close()
+                process.join()
+                if succeeded:
+                    yield key, value, None
+                else:
+                    yield key, None, value or f"job process exited with code {process.exitcode}"
+
+            now = time.monotonic()
+            for reader, (key, process, deadline) in list(running.items()):
+                if deadline is not None and now >= deadline:
+                    process.kill()
+                    process.join()
+                    reader.close()
+                    del running[reader]
+                    yield key, None, f"timed out after {timeout} s"
+    finally:
+        # Stopped early (an error in the caller, Ctrl-C): leave no job behind
+        for reader, (key, process, deadline) in running.items():
+            process.kill()
+            process.join()
+            reader.close()
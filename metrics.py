@@ -0,0 +1,154 @@
+import contextlib
+import datetime
+import importlib.util
+import logging
+import os
+import time
+
+import flask
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this many seconds have their profile written to
+# PROFILE_DIR. Profiling is off unless it is set, and needs pyinstrument.
+PROFILE_SLOW_SECONDS = float(os.environ.get("PROFILE_SLOW_SECONDS", 0)) or None
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+CALLBACK_PATH = "/_dash-update-component"
+
+STARTUP_SECONDS = Gauge(
+    "dashboard_startup_phase_seconds",
+    "Time spent in each phase of the app startup",
+    ["phase"],
+    multiprocess_mode="max",
+)
+CALLBACK_SECONDS = Histogram(
+    "dashboard_callback_seconds",
+    "Time to answer a callback request, by callback and input values",
+    ["callback", "input"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+RESPONSE_BYTES = Histogram(
+    "dashboard_callback_response_bytes",
+    "Size of the callback responses",
+    ["callback"],
+    buckets=(1e3, 3e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7),
+)
+FIGURE_CACHE_REQUESTS = Counter(
+    "dashboard_figure_cache_requests_total",
+    "Figure cache lookups, by figure and result (hit or miss)",
+    ["figure", "result"],
+)
+SLOW_PROFILES = Counter(
+    "dashboard_slow_request_profiles_total",
+    "Profiles written for requests slower than PROFILE_SLOW_SECONDS",
+    ["callback"],
+)
+
+
+# Time a startup phase, e.g. `with metrics.startup_phase("data_load"):`
+@contextlib.contextmanager
+def startup_phase(phase):
+    start = time.perf_counter()
+    yield
+    STARTUP_SECONDS.labels(phase).set(time.perf_counter() - start)
+
+
+def figure_cache_lookup(figure, hit):
+    FIGURE_CACHE_REQUESTS.labels(figure, "hit" if hit else "miss").inc()
+
+
+# Name of the callback answering a request, and its input values joined like
+# the keys of the static views ("NO_2|2005"). Only the scalar values of
+# dropdowns, sliders and radio items are kept: they come from a fixed set of
+# options, so the label values stay bounded, while stores (such as the
+# daily-view zoom range) and other properties could take any value.
+def describe_callback(app, body):
+    callback = app.callback_map.get(body.get("output"), {}).get("callback")
+    name = getattr(callback, "__name__", body.get("output", "unknown"))
+    values = "|".join(
+        str(item["value"])
+        for item in body.get("inputs", [])
+        if isinstance(item, dict)
+        and item.get("property") == "value"
+        and isinstance(item.get("value"), (str, int, float, bool, type(None)))
+    )
+    return name, values
+
+
+def start_profiler():
+    from pyinstrument import Profiler
+
+    profiler = Profiler()
+    profiler.start()
+    return profiler
+
+
+def save_profile(profiler, name, values):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    path = os.path.join(PROFILE_DIR, f"{stamp}_{name}.html")
+    with open(path, "w") as f:
+        f.write(profiler.output_html())
+    SLOW_PROFILES.labels(name).inc()
+    logger.warning("Slow callback %s(%s), profile written to %s", name, values, path)
+
+
+# Registry served by /metrics. Under gunicorn (see gunicorn.conf.py) every
+# process writes its values to PROMETHEUS_MULTIPROC_DIR and they are merged
+# here, whichever worker answers the scrape.
+def registry():
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        from prometheus_client import REGISTRY
+
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+# Time every callback request of a Dash app, record its response size,
+# optionally profile it, and serve everything on /metrics
+def instrument(app):
+    server = app.server
+    profiling = PROFILE_SLOW_SECONDS is not None
+    if profiling and importlib.util.find_spec("pyinstrument") is None:
+        logger.warning("PROFILE_SLOW_SECONDS is set but pyinstrument is not installed, not profiling")
+        profiling = False
+
+    @server.before_request
+    def start_timer():
+        if flask.request.path == CALLBACK_PATH:
+            flask.g.callback_start = time.perf_counter()
+            if profiling:
+                flask.g.profiler = start_profiler()
+
+    @server.after_request
+    def record_callback(response):
+        start = flask.g.pop("callback_start", None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        name, values = describe_callback(app, flask.request.get_json(silent=True) or {})
+        CALLBACK_SECONDS.labels(name, values).observe(elapsed)
+        RESPONSE_BYTES.labels(name).observe(response.calculate_content_length() or 0)
+
+        profiler = flask.g.pop("profiler", None)
+        if profiler is not None:
+            profiler.stop()
+            if elapsed > PROFILE_SLOW_SECONDS:
+                save_profile(profiler, name, values)
+        return response
+
+    @server.route("/metrics")
+    def serve_metrics():
+        return flask.Response(generate_latest(registry()), content_type=CONTENT_TYPE_LATEST)
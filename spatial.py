@@ -0,0 +1,138 @@
+import base64
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+
+import numpy as np
+
+# Cells along the longer side of the grid covering the stations (0 turns the
+# surface off). Each frame is one PNG of about this many pixels squared.
+GRID_SIZE = int(os.environ.get("MAP_GRID_SIZE", 200))
+# Inverse distance weighting over the nearest stations of each cell
+NEIGHBOURS = int(os.environ.get("MAP_IDW_NEIGHBOURS", 8))
+POWER = 2
+# Margin of the grid around the outermost stations, and the distance under
+# which a cell takes the value of the station it holds
+PADDING_KM = 2.0
+MIN_DISTANCE_KM = 0.01
+KM_PER_DEGREE = 111.32
+
+
+# Everything that changes the frames, part of their cache key
+def settings():
+    return (GRID_SIZE, NEIGHBOURS, POWER, PADDING_KM)
+
+
+# Regular grid over the stations: its corners as [lon, lat] (north-west,
+# north-east, south-east, south-west, the order of map image layers), its
+# shape, and the position of every cell (row by row from the north-west) and
+# station in kilometres from the centre of the stations
+@dataclass(frozen=True)
+class Grid:
+    corners: list
+    shape: tuple
+    cells: np.ndarray
+    stations: np.ndarray
+
+
+def project(lat, lon, origin_lat, origin_lon):
+    return np.column_stack(
+        [
+            (np.asarray(lon) - origin_lon) * KM_PER_DEGREE * np.cos(np.radians(origin_lat)),
+            (np.asarray(lat) - origin_lat) * KM_PER_DEGREE,
+        ]
+    )
+
+
+def build_grid(station_lat, station_lon, size=GRID_SIZE):
+    origin_lat, origin_lon = np.mean(station_lat), np.mean(station_lon)
+    x, y = project(station_lat, station_lon, origin_lat, origin_lon).T
+    west, south = x.min() - PADDING_KM, y.min() - PADDING_KM
+    step = (max(x.max() - x.min(), y.max() - y.min()) + 2 * PADDING_KM) / size
+    shape = (
+        max(round((y.max() + PADDING_KM - south) / step), 1),
+        max(round((x.max() + PADDING_KM - west) / step), 1),
+    )
+    east, north = west + step * shape[1], south + step * shape[0]
+    columns = west + step * (np.arange(shape[1]) + 0.5)
+    rows = north - step * (np.arange(shape[0]) + 0.5)
+
+    lon_per_km = 1 / (KM_PER_DEGREE * np.cos(np.radians(origin_lat)))
+    west, east = origin_lon + west * lon_per_km, origin_lon + east * lon_per_km
+    north, south = origin_lat + north / KM_PER_DEGREE, origin_lat + south / KM_PER_DEGREE
+    return Grid(
+        corners=[[float(lon), float(lat)] for lon, lat in [(west, north), (east, north), (east, south), (west, south)]],
+        shape=shape,
+        cells=np.column_stack([np.tile(columns, shape[0]), np.repeat(rows, shape[1])]),
+        stations=np.column_stack([x, y]),
+    )
+
+
+# Value of every cell (flattened, row by row) weighted by the inverse of its
+# distance to each of its nearest stations with a value. The nearest
+# stations of all the cells are found at once with a KD-tree. When there are
+# more stations than neighbours, the weights are tapered to zero at the next
+# nearest station (Franke and Nielson's modified Shepard weights), so the
+# surface stays smooth where the set of nearest stations changes.
+def interpolate(grid, values, neighbours=NEIGHBOURS, power=POWER):
+    from scipy.spatial import cKDTree
+
+    known = ~np.isnan(values)
+    if not known.any():
+        return np.full(len(grid.cells), np.nan)
+    count = min(neighbours + 1, int(known.sum()))
+    distances, nearest = cKDTree(grid.stations[known]).query(grid.cells, k=list(range(1, count + 1)))
+    station_values = values[known][nearest]
+    clamped = np.maximum(distances, MIN_DISTANCE_KM)
+    if count > neighbours:
+        radius = distances[:, -1:]
+        weights = ((radius - clamped[:, :-1]) / (radius * clamped[:, :-1])) ** power
+        station_values = station_values[:, :-1]
+    else:
+        weights = clamped**-power
+    surface = (weights * station_values).sum(axis=1) / weights.sum(axis=1)
+    return np.where(distances[:, 0] < MIN_DISTANCE_KM, station_values[:, 0], surface)
+
+
+# RGBA pixels of the values on a colorscale of (position, "#rrggbb") stops
+# between `low` and `high`. Cells without a value are transparent.
+def colorize(values, low, high, colorscale):
+    positions = [position for position, _ in colorscale]
+    scaled = np.clip((values - low) / ((high - low) or 1), 0, 1)
+    channels = [
+        np.interp(scaled, positions, [int(color[1 + 2 * i : 3 + 2 * i], 16) for _, color in colorscale])
+        for i in range(3)
+    ]
+    alpha = np.where(np.isnan(values), 0, 255)
+    return np.stack([*channels, alpha], axis=-1).round().astype(np.uint8)
+
+
+# Minimal PNG of 8-bit RGBA pixels, so the frames need no imaging library
+def png(pixels):
+    height, width, _ = pixels.shape
+    # Every row starts with its filter type, 0 (none)
+    rows = np.hstack([np.zeros((height, 1), np.uint8), pixels.reshape(height, -1)])
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+            chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)),
+            chunk(b"IEND", b""),
+        ]
+    )
+
+
+# Interpolated surface of one set of station values, as the source and
+# corner coordinates of a map image layer
+def raster_frame(grid, values, low, high, colorscale):
+    surface = interpolate(grid, np.asarray(values, dtype=np.float64))
+    pixels = colorize(surface.reshape(grid.shape), low, high, colorscale)
+    return {
+        "source": "data:image/png;base64," + base64.b64encode(png(pixels)).decode(),
+        "coordinates": grid.corners,
+    }
@@ -0,0 +1,45 @@
+import importlib
+import importlib.util
+import os
+import sys
+import time
+
+import metrics
+
+# STARTUP_MODE=fast puts off everything the server does not need to answer
+# its first requests: heavy modules are imported on first use, and missing
+# forecasts are fitted when the forecast tab first asks for them instead of
+# before the server starts listening
+FAST = os.environ.get("STARTUP_MODE", "full") == "fast"
+
+# Time allowed for importing app.py in fast mode, reported on boot. Measured
+# at about 1.9 s with the Arrow data file and stored forecasts, most of it
+# importing dash and pandas.
+IMPORT_BUDGET_SECONDS = float(os.environ.get("IMPORT_BUDGET_SECONDS", 2.5))
+
+
+# Module imported when one of its attributes is first used in fast mode,
+# right away otherwise
+def lazy_import(name):
+    if not FAST or name in sys.modules:
+        return importlib.import_module(name)
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def report_import(started):
+    elapsed = time.perf_counter() - started
+    metrics.STARTUP_SECONDS.labels("app_import").set(elapsed)
+    mode = "fast" if FAST else "full"
+    status = "over" if elapsed > IMPORT_BUDGET_SECONDS else "within"
+    print(
+        f"Imported app.py in {elapsed:.2f} s ({mode} startup), "
+        f"{status} the {IMPORT_BUDGET_SECONDS:.2f} s budget",
+        file=sys.stderr,
+        flush=True,
+    )
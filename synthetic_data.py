@@ -0,0 +1,160 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+import data_store
+
+# Columns of the raw madrid_YYYY.csv files, in their order
+RAW_COLUMNS = ["BEN", "CH4", "CO", "EBE", "NMHC", "NO", "NO_2", "NOx", "O_3", "PM10", "PM25", "SO_2", "TCH", "TOL"]
+STATION_COLUMNS = ["id", "name", "address", "lon", "lat", "elevation"]
+
+# Typical level of each pollutant and the day of the year it peaks on:
+# combustion pollutants peak in winter, ozone in summer
+LEVELS = {
+    "BEN": (1.2, 15), "CH4": (1.3, 15), "CO": (0.5, 15), "EBE": (1.3, 15),
+    "NMHC": (0.2, 15), "NO": (25.0, 15), "NO_2": (45.0, 15), "NOx": (85.0, 15),
+    "O_3": (45.0, 196), "PM10": (25.0, 200), "PM25": (11.0, 15), "SO_2": (8.0, 15),
+    "TCH": (1.4, 15), "TOL": (5.0, 15),
+}
+# Metadata column marking ("X") the stations measuring each pollutant
+MEASURED_BY = {
+    "BEN": "BTX", "CH4": "BTX", "CO": "CO", "EBE": "BTX", "NMHC": "BTX",
+    "NO": "NO2", "NO_2": "NO2", "NOx": "NO2", "O_3": "O3", "PM10": "PM10",
+    "PM25": "PM2_5", "SO_2": "SO2", "TCH": "BTX", "TOL": "BTX",
+}
+# Yearly change of every level, the city slowly getting cleaner
+TREND = -0.02
+# Rows generated (and written) at a time
+BLOCK_ROWS = 1_000_000
+
+
+# Station table with the names, codes and positions of the stations in the
+# metadata file. Beyond the 24 real stations, the list is cycled: copies keep
+# the name of their station (so the app still finds their area) but get their
+# own code and a position moved by up to ~1 km.
+def make_stations(count, rng):
+    metadata = data_store.load_metadata()
+    source = metadata.iloc[np.arange(count) % len(metadata)].reset_index(drop=True)
+    copy = np.arange(count) // len(metadata)
+    jitter = np.where(copy > 0, 1, 0)[:, None] * rng.uniform(-0.01, 0.01, (count, 2))
+    stations = pd.DataFrame(
+        {
+            "id": (source["CODIGO"] + copy * 1000).astype("int64"),
+            "name": source["ESTACION"],
+            "address": source["DIRECCION"],
+            "lon": (source["LONGITUD"] + jitter[:, 0]).round(7),
+            "lat": (source["LATITUD"] + jitter[:, 1]).round(7),
+            "elevation": source["ALTITUD"],
+        }
+    )
+    measured = pd.DataFrame(
+        {pollutant: source[column].eq("X").to_numpy() for pollutant, column in MEASURED_BY.items()}
+    )
+    return stations, measured
+
+
+# Hourly values for a block of hours, for every station, ordered by date then
+# station like the real files. Missing values are nulls, written as empty
+# fields.
+def hourly_block(hours, stations, measured, year, settings, rng):
+    rows = len(hours) * len(stations)
+    day_of_year = np.repeat(hours.dayofyear.to_numpy(), len(stations))
+    hour = np.repeat(hours.hour.to_numpy(), len(stations))
+    block = {"date": pa.array(np.repeat(hours.strftime("%Y-%m-%d %H:%M:%S").to_numpy(), len(stations)))}
+
+    # Rush hour peaks in the morning and evening
+    daily_cycle = 1 + 0.3 * np.cos(2 * np.pi * (hour - 8) / 12)
+    trend = (1 + TREND) ** (year - settings.start_year)
+    for pollutant in RAW_COLUMNS:
+        level, peak_day = LEVELS[pollutant]
+        season = 1 + settings.seasonality * np.cos(2 * np.pi * (day_of_year - peak_day) / 365.25)
+        values = level * trend * season * daily_cycle * rng.lognormal(0, 0.4, rows)
+        values[rng.random(rows) < settings.missing_rate] = np.nan
+        if not settings.measure_all:
+            values[~np.tile(measured[pollutant].to_numpy(), len(hours))] = np.nan
+        block[pollutant] = pa.array(values.round(2), from_pandas=True)
+    block["station"] = pa.array(np.tile(stations["id"].to_numpy(), len(hours)))
+    return pa.table(block)
+
+
+def write_year(year, settings):
+    rng = np.random.default_rng([settings.seed, year])
+    stations, measured = make_stations(settings.stations, np.random.default_rng(settings.seed))
+    # Readings are stamped at the end of their hour, as in the real files
+    hours = pd.date_range(f"{year}-01-01 01:00", f"{year + 1}-01-01 00:00", freq="h")
+    hours_per_block = max(1, BLOCK_ROWS // len(stations))
+
+    # pyarrow writes CSV about ten times faster than pandas, which matters
+    # at 100x the real volume
+    file_name = os.path.join(settings.output_dir, f"madrid_{year}.csv")
+    writer = None
+    for start in range(0, len(hours), hours_per_block):
+        block = hourly_block(hours[start:start + hours_per_block], stations, measured, year, settings, rng)
+        if writer is None:
+            writer = pacsv.CSVWriter(
+                file_name + ".tmp",
+                block.schema,
+                write_options=pacsv.WriteOptions(quoting_style="needed"),
+            )
+        writer.write_table(block)
+    writer.close()
+    os.replace(file_name + ".tmp", file_name)
+    return file_name
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic madrid_YYYY.csv and stations.csv files for data_prep_day.py"
+    )
+    parser.add_argument("--output-dir", default=".", help="directory the files are written to (default: .)")
+    parser.add_argument(
+        "--stations",
+        type=int,
+        default=24,
+        help="number of stations, 24 is the size of the real network; use 240 or 2400 "
+        "for 10x or 100x the real volume (default: 24)",
+    )
+    parser.add_argument("--start-year", type=int, default=2001, help="first year (default: 2001)")
+    parser.add_argument("--end-year", type=int, default=2018, help="last year (default: 2018)")
+    parser.add_argument(
+        "--missing-rate",
+        type=float,
+        default=0.1,
+        help="share of hourly values left empty (default: 0.1)",
+    )
+    parser.add_argument(
+        "--seasonality",
+        type=float,
+        default=0.3,
+        help="amplitude of the yearly cycle relative to the level, 0 to disable (default: 0.3)",
+    )
+    parser.add_argument(
+        "--measure-all",
+        action="store_true",
+        help="give every station every pollutant instead of the ones it measures in the metadata file",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes writing the yearly files (default: one per CPU)",
+    )
+    settings = parser.parse_args()
+
+    os.makedirs(settings.output_dir, exist_ok=True)
+    stations, _ = make_stations(settings.stations, np.random.default_rng(settings.seed))
+    stations[STATION_COLUMNS].to_csv(os.path.join(settings.output_dir, "stations.csv"), index=False)
+
+    years = range(settings.start_year, settings.end_year + 1)
+    with ProcessPoolExecutor(max_workers=settings.workers) as executor:
+        for file_name in executor.map(write_year, years, [settings] * len(years)):
+            print(f"Wrote {file_name}")
+
+
+if __name__ == "__main__":
+    main()